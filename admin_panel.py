@@ -1,45 +1,42 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-def get_admin_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="���� Статистика", callback_data="admin_stats"),
-            InlineKeyboardButton(text="🔑 Выдать ключ", callback_data="admin_give_key")
-        ],
-        [
-            InlineKeyboardButton(text="🚫 Заблокировать пользователя", callback_data="admin_block_user"),
-            InlineKeyboardButton(text="🛠 Управление серверами", callback_data="admin_manage_servers")
-        ],
-        [
-            InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast"),
-            InlineKeyboardButton(text="💵 Редактировать цены", callback_data="admin_edit_prices")
-        ]
-    ])
-    return keyboard
+from callback_router import callback_data
 
-def get_servers_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="➕ Добавить сервер", callback_data="admin_add_server"),
-            InlineKeyboardButton(text="➖ Удалить сервер", callback_data="admin_remove_server")
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")
-        ]
-    ])
-    return keyboard
+# Статичные меню админ-панели строятся один раз при импорте
+ADMIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="���� Статистика", callback_data="admin_stats"),
+        InlineKeyboardButton(text="🔑 Выдать ключ", callback_data="admin_give_key")
+    ],
+    [
+        InlineKeyboardButton(text="🚫 Заблокировать пользователя", callback_data="admin_block_user"),
+        InlineKeyboardButton(text="🛠 Управление серверами", callback_data="admin_manage_servers")
+    ],
+    [
+        InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast"),
+        InlineKeyboardButton(text="💵 Редактировать цены", callback_data="admin_edit_prices")
+    ],
+    [
+        InlineKeyboardButton(text="🏆 Топ рефереров", callback_data="admin_referrals")
+    ]
+])
+
+SERVERS_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="➕ Добавить сервер", callback_data="admin_add_server"),
+        InlineKeyboardButton(text="➖ Удалить сервер", callback_data="admin_remove_server")
+    ],
+    [
+        InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")
+    ]
+])
 
-def get_prices_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="1 месяц - 300 руб", callback_data="edit_price_1_month"),
-            InlineKeyboardButton(text="3 месяца - 800 руб", callback_data="edit_price_3_months")
-        ],
-        [
-            InlineKeyboardButton(text="6 месяцев - 1500 руб", callback_data="edit_price_6_months")
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")
-        ]
-    ])
+def get_prices_menu(tariffs):
+    buttons = [
+        InlineKeyboardButton(text=f"{tariff.title} - {tariff.amount:g} руб", callback_data=callback_data("edit_price", tariff.tariff))
+        for tariff in tariffs
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
     return keyboard
@@ -0,0 +1,76 @@
+import asyncio
+import glob
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class BackupScheduler:
+    # Резервная копия работающей базы через backup API SQLite. Копирование идёт в отдельном потоке
+    # по pages страниц за шаг с паузой между шагами: диск не забивается, цикл событий не ждёт.
+    # Исходное соединение держит открытую транзакцию чтения, поэтому копия — снимок на момент начала,
+    # а записи других соединений (в WAL они не блокируются) не заставляют копирование начинаться заново
+    def __init__(self, db_file, directory="backups", interval=24 * 3600, keep=7, pages=256, pause=0.01):
+        self.db_file = db_file
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+        self.lock = asyncio.Lock()
+        self.last = None  # (путь, размер, секунд) последней удачной копии
+
+    def copy(self, path):
+        source = sqlite3.connect(self.db_file)
+        target = sqlite3.connect(path)
+        try:
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # фиксируем снимок
+            source.backup(target, pages=self.pages, sleep=self.pause)
+            source.rollback()
+            # Копия — обычная база без WAL, её можно просто скопировать или открыть
+            target.execute("PRAGMA journal_mode=DELETE")
+            result = target.execute("PRAGMA quick_check").fetchone()[0]
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"проверка копии: {result}")
+        finally:
+            target.close()
+            source.close()
+
+    async def backup(self):
+        async with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            name = os.path.splitext(os.path.basename(self.db_file))[0]
+            path = os.path.join(self.directory, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+            partial = path + ".part"
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self.copy, partial)
+                os.replace(partial, path)  # неполная копия никогда не лежит под итоговым именем
+            except Exception:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            elapsed = time.monotonic() - started
+            self.last = (path, os.path.getsize(path), elapsed)
+            logger.info(f"Резервная копия {path}: {self.last[1] / 1024 / 1024:.1f} МБ за {elapsed:.1f} сек.")
+            self.rotate(name)
+            return self.last
+
+    def rotate(self, name):
+        # Имена содержат дату, поэтому сортировка по имени — по времени создания
+        backups = sorted(glob.glob(os.path.join(self.directory, f"{name}_*.db")))
+        for path in backups[:-self.keep] if self.keep > 0 else []:
+            os.remove(path)
+            logger.info(f"Удалена старая резервная копия {path}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backup()
+            except Exception as e:
+                logger.error(f"Ошибка при резервном копировании: {e}")
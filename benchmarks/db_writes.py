@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+# Сравнение скорости вставки пользователей (как при наплыве по реферальной ссылке):
+#   before — прежняя схема: sqlite3, журнал отката, коммит на каждую вставку
+#   after  — Database: WAL, очередь группового коммита, параллельные обработчики
+# Запуск: python benchmarks/db_writes.py --users 5000 --concurrency 200
+
+def bench_before(path, users):
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, user_id INTEGER UNIQUE, balance REAL DEFAULT 0, earned REAL DEFAULT 0, referral_id INTEGER DEFAULT NULL)")
+    connection.commit()
+    started = time.perf_counter()
+    for user_id in range(users):
+        with connection:
+            cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return elapsed
+
+async def bench_after(path, users, concurrency):
+    db = Database(path)
+    await db.connect()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handler(user_id):
+        async with semaphore:
+            await db.add_user(user_id)
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(handler(user_id) for user_id in range(users)))
+        return time.perf_counter() - started
+    finally:
+        await db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Скорость вставки в базу до и после группового коммита")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременных обработчиков в режиме after")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        before = bench_before(os.path.join(directory, "before.db"), args.users)
+        after = asyncio.run(bench_after(os.path.join(directory, "after.db"), args.users, args.concurrency))
+
+    print(f"before: {args.users / before:10.0f} вставок/сек. ({before:.2f} сек.)")
+    print(f"after:  {args.users / after:10.0f} вставок/сек. ({after:.2f} сек.)")
+    print(f"ускорение: x{before / after:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage, EditMessageText, GetMe
+from aiogram.types import Message, User
+
+from stubs import create_node_app
+
+# Нагрузочный тест: настоящие dp и обработчики из bot.py, вместо Telegram — локальная заглушка сессии,
+# вместо узла VPN — заглушка из stubs.py. Результат пишется в JSON для сравнения между версиями.
+# Запуск: python benchmarks/load_test.py --users 2000 --concurrency 100 --output load_test.json
+#         python benchmarks/load_test.py --mix start=1,get_key=1,my_keys=3 --api-latency 0.05
+
+DEFAULT_MIX = "get_key=2,buy=1,my_keys=3,referral=1,instruction=1"
+BOT_ID = 1
+
+class FakeSession(BaseSession):
+    # Отвечает на методы Bot API так, как ответил бы Telegram, с заданной задержкой
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}
+        self.message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message.model_validate({
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": method.chat_id or 0, "type": "private"},
+                "text": method.text,
+            })
+        if isinstance(method, GetMe):
+            return User(id=BOT_ID, is_bot=True, first_name="bench", username="bench_bot")
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+class Updates:
+    def __init__(self):
+        self.ids = itertools.count(1)
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text):
+        update_id = next(self.ids)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def callback(self, user_id, data):
+        update_id = next(self.ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "from": self.user(user_id),
+            "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "menu"},
+        }}
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def summarize(latencies, elapsed):
+    return {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "max_ms": round(max(latencies) * 1000, 2) if latencies else None,
+    }
+
+def db_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+async def table_counts(db):
+    counts = {}
+    for table in ("users", "keys", "pending_payments", "ledger", "key_pool"):
+        counts[table] = (await db.fetchone(f"SELECT COUNT(*) FROM {table}"))[0]
+    return counts
+
+def user_script(user_id, referrer, mix, actions, updates, tariffs):
+    # Первое действие — всегда /start (по реферальной ссылке, если есть пригласивший)
+    yield "start", updates.message(user_id, f"/start {referrer}" if referrer else "/start")
+    names, weights = zip(*mix.items())
+    for action in random.choices(names, weights, k=actions):
+        if action == "start":
+            yield action, updates.message(user_id, "/start")
+        elif action == "buy":
+            yield action, updates.callback(user_id, "buy_vpn")
+            yield action, updates.callback(user_id, f"buy:{random.choice(tariffs)}")
+        elif action == "instruction":
+            yield action, updates.callback(user_id, random.choice(("instruction", "instruction:android", "instruction:ios")))
+        else:
+            yield action, updates.callback(user_id, action)
+
+async def run(args, directory):
+    os.environ["DATABASE_PATH"] = os.path.join(directory, "load_test.db")
+    os.environ["BOT_TOKEN"] = "123456:LOADTEST"  # настоящий токен из .env не нужен и не используется
+    os.environ["ADMIN_ID"] = "1"
+    if not args.throttle:
+        os.environ["THROTTLE_RATE"] = "1000000"  # без --throttle измеряем обработчики, а не защиту от флуда
+    os.environ["PAYMENT_API_URL"] = ""  # платежи — встроенные заглушки payment_handler
+    os.chdir(directory)  # bot.log и прочие файлы бота — во временном каталоге
+    import bot as app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    session = FakeSession(args.api_latency)
+    app.bot.session = session
+    node = create_node_app(args.node_latency)
+    runner = web.AppRunner(node, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.node_port).start()
+
+    db = app.db
+    await db.connect()
+    tasks = []
+    try:
+        await app.catalog.load()
+        await db.add_server("127.0.0.1", args.node_port, "vless", capacity=10 ** 9)
+        if args.pool:
+            tasks.append(asyncio.create_task(app.key_pool.run()))
+            await asyncio.sleep(1)
+        tariffs = [tariff.tariff for tariff in app.catalog.snapshot.tariffs]
+        size_before = db_size(os.environ["DATABASE_PATH"])
+
+        updates = Updates()
+        mix = parse_mix(args.mix)
+        latencies = {}
+        errors = 0
+        semaphore = asyncio.Semaphore(args.concurrency)
+        first_user = 10 ** 9
+        started_users = []  # пользователи, которые уже прошли /start: их приглашают следующие
+
+        async def simulate(user_id):
+            nonlocal errors
+            referrer = None
+            if started_users and random.random() < args.referral_rate:
+                # Недавние пользователи приглашают чаще: получаются цепочки рефералов
+                referrer = started_users[-random.randint(1, min(len(started_users), args.referral_window))]
+            async with semaphore:
+                for action, update in user_script(user_id, referrer, mix, args.actions, updates, tariffs):
+                    started = time.perf_counter()
+                    try:
+                        await app.dp.feed_raw_update(app.bot, update)
+                    except Exception as e:
+                        errors += 1
+                        logging.warning(f"{action}: {e}")
+                    latencies.setdefault(action, []).append(time.perf_counter() - started)
+                    if action == "start" and user_id not in started_users:
+                        started_users.append(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate(first_user + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        await db.commit_queue.join()
+        counts = await table_counts(db)
+        size_after = db_size(os.environ["DATABASE_PATH"])
+        everything = [value for values in latencies.values() for value in values]
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": vars(args),
+            "elapsed_s": round(elapsed, 3),
+            "errors": errors,
+            "total": summarize(everything, elapsed),
+            "actions": {action: summarize(values, elapsed) for action, values in sorted(latencies.items())},
+            "telegram_calls": session.calls,
+            "node_requests": node["requests"],
+            "throttled": dict(app.throttling.dropped),
+            "db": {
+                "size_before_bytes": size_before,
+                "size_after_bytes": size_after,
+                "growth_bytes": size_after - size_before,
+                "rows": counts,
+            },
+        }
+    finally:
+        for task in tasks:
+            task.cancel()
+        await db.close()
+        await app.nodes.close()
+        await app.health.close()
+        await runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--actions", type=int, default=5, help="действий на пользователя после /start")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса действий: start, get_key, buy, my_keys, referral, instruction")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument("--referral-rate", type=float, default=0.5, help="доля пользователей, пришедших по реферальной ссылке")
+    parser.add_argument("--referral-window", type=int, default=20, help="из скольких последних пользователей выбирается пригласивший")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, секунд")
+    parser.add_argument("--node-latency", type=float, default=0.0, help="задержка ответа узла, секунд")
+    parser.add_argument("--node-port", type=int, default=18181)
+    parser.add_argument("--pool", action="store_true", help="выдавать ключи из пула KeyPool")
+    parser.add_argument("--throttle", action="store_true", help="не отключать защиту от флуда (THROTTLE_RATE из окружения)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as directory:
+        result = asyncio.run(run(args, directory))
+
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(result, file, ensure_ascii=False, indent=2)
+    total = result["total"]
+    print(f"{total['count']} обновлений за {result['elapsed_s']} сек.: {total['throughput']:.0f}/сек., "
+          f"p50 {total['p50_ms']} мс, p95 {total['p95_ms']} мс, p99 {total['p99_ms']} мс, ошибок {result['errors']}")
+    for action, summary in result["actions"].items():
+        print(f"  {action:12} {summary['count']:7} p50 {summary['p50_ms']:8} мс  p95 {summary['p95_ms']:8} мс  p99 {summary['p99_ms']:8} мс")
+    if any(result["throttled"].values()):
+        print(f"отброшено защитой от флуда: {result['throttled']}")
+    print(f"база: +{result['db']['growth_bytes'] / 1024:.0f} КБ, строк: {result['db']['rows']}")
+    print(f"результат: {output}")
+
+if __name__ == "__main__":
+    main()
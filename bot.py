@@ -1,33 +1,98 @@
 import asyncio
 import logging
-from datetime import datetime
+import math
+import time
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.default import DefaultBotProperties
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 import os
-from database import Database
-from payment_handler import create_payment
-from vless_generator import generate_key, get_expiration_date
-from referral_system import generate_referral_link, get_referral_info
-from admin_panel import get_admin_menu, get_servers_menu, get_prices_menu
+from database import Database, SERVER_SETTINGS
+from server_allocator import DEFAULT_CAPACITY
+from expiry_scheduler import ExpiryScheduler
+from broadcast import Broadcaster
+from bulk import BulkOperations
+from export import DataExporter, parse_export_args
+from backup import BackupScheduler
+from server_manager import NodeClient
+from key_pool import KeyPool
+from health import HealthMonitor, format_health
+from subscription import SubscriptionCache, start_subscription_server
+from metrics import REGISTRY, HandlerMetrics, InFlightMetrics, TelegramMetrics, instrument, start_metrics_server
+from logging_setup import LogContext, setup_logging
+from throttling import Throttling
+from stats import StatsCache, format_stats
+from tariffs import TariffCatalog
+from webhook import run_webhook
+from payment_handler import create_payment, close as close_payment_client
+from payment_reconciler import PaymentReconciler
+from vless_generator import generate_key, get_expiration_ts, format_expiration
+from referral_system import ReferralLeaderboard, generate_referral_link, get_referral_info, format_leaderboard, format_downline
+from admin_panel import ADMIN_MENU, SERVERS_MENU
+from callback_router import CallbackRouter
+from menus import MAIN_MENU, INSTRUCTION_MENU, REFERRAL_MENU, INSTRUCTIONS
 
 # ��агружаем переменные из .env
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
-
-# Логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
+DATABASE_PATH = os.getenv("DATABASE_PATH", "database.db")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # Лимит Telegram — около 30 сообщений в секунду
+KEY_POOL_MIN = int(os.getenv("KEY_POOL_MIN", "20"))  # Минимальный запас готовых ключей на сервер
+KEY_POOL_MAX = int(os.getenv("KEY_POOL_MAX", "1000"))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://vpn.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "100"))
+
+# Сервер подписок для клиентских приложений
+SUB_HOST = os.getenv("SUB_HOST", "127.0.0.1")
+SUB_PORT = int(os.getenv("SUB_PORT", "8090"))
+SUB_URL = os.getenv("SUB_URL", f"http://{SUB_HOST}:{SUB_PORT}")  # Публичный адрес, под которым сервер виден клиентам
+
+# Защита от флуда: нажатий в секунду на пользователя в среднем и подряд, одновременно обрабатываемых обновлений
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "5"))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "50"))
+MAX_WAITING_UPDATES = int(os.getenv("MAX_WAITING_UPDATES", "200"))
+
+# Резервные копии базы: каталог, период в часах и сколько последних копий хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
+# Метрики в формате Prometheus
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Логирование: запись в файл и консоль в отдельном потоке, ротация и прореживание повторяющихся ошибок
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_JSON = os.getenv("LOG_FORMAT", "text") == "json"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")  # Например, midnight — ротация по времени вместо размера
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))  # Повторов одной ошибки за период, остальные подавляются
+LOG_SAMPLE_PERIOD = float(os.getenv("LOG_SAMPLE_PERIOD", "60"))
+
+logs = setup_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    json_format=LOG_JSON,
+    max_bytes=LOG_MAX_BYTES,
+    backups=LOG_BACKUPS,
+    rotate_when=LOG_ROTATE_WHEN,
+    sample_burst=LOG_SAMPLE_BURST,
+    sample_period=LOG_SAMPLE_PERIOD,
 )
 logger = logging.getLogger(__name__)
 
@@ -35,67 +100,120 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 dp["bot"] = bot
-db = Database("database.db")
-
-# Меню с inline-кнопками
-def get_main_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🆓 Бесплатный VPN", callback_data="get_key"),
-            InlineKeyboardButton(text="💳 Купить/Продлить VPN", callback_data="buy_vpn")
-        ],
-        [
-            InlineKeyboardButton(text="🔑 Мои ключи", callback_data="my_keys"),
-            InlineKeyboardButton(text="👥 Реферальная программа", callback_data="referral")
-        ],
-        [
-            InlineKeyboardButton(text="📚 Инструкция", callback_data="instruction")
-        ]
-    ])
-    return keyboard
-
-# Меню с выбором тарифов
-def get_payment_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="1 месяц - 300 руб", callback_data="buy_1_month"),
-            InlineKeyboardButton(text="3 месяца - 800 руб", callback_data="buy_3_months")
-        ],
-        [
-            InlineKeyboardButton(text="6 месяцев - 1500 руб", callback_data="buy_6_months")
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
-        ]
-    ])
-    return keyboard
-
-# Меню инструкций
-def get_instruction_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="Android", callback_data="instruction_android"),
-            InlineKeyboardButton(text="iOS", callback_data="instruction_ios")
-        ],
-        [
-            InlineKeyboardButton(text="MacOS", callback_data="instruction_macos"),
-            InlineKeyboardButton(text="Windows", callback_data="instruction_windows")
-        ],
-        [
-            InlineKeyboardButton(text="TV", callback_data="instruction_tv")
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
-        ]
-    ])
-    return keyboard
+router = CallbackRouter()  # Все нажатия кнопок разбираются одним обработчиком (см. handle_callback)
+db = instrument(Database(DATABASE_PATH), skip=("connect", "close", "commit_loop"))
+expiry = ExpiryScheduler(db, bot)
+db.key_listeners.append(expiry)
+subscriptions = SubscriptionCache(db)
+db.key_listeners.append(subscriptions)
+broadcaster = Broadcaster(db, bot, rate=BROADCAST_RATE)
+nodes = NodeClient()
+key_pool = KeyPool(db, nodes, min_size=KEY_POOL_MIN, max_size=KEY_POOL_MAX)
+health = HealthMonitor(db)
+stats_cache = StatsCache(db)
+leaderboard = ReferralLeaderboard(db)
+bulk = BulkOperations(db, nodes, bot)
+exporter = DataExporter(db, bot)
+backups = BackupScheduler(DATABASE_PATH, BACKUP_DIR, interval=BACKUP_INTERVAL * 3600, keep=BACKUP_KEEP)
+catalog = TariffCatalog(db)
+
+# Время обработчиков, ошибки и число обновлений в обработке; для кнопок — по маршрутам CallbackRouter
+def callback_label(callback, data):
+    resolved = router.resolve(callback.data)
+    return resolved[0].__name__ if resolved else "unknown_callback"
+
+dp.update.outer_middleware(InFlightMetrics())
+# Один экземпляр на сообщения и кнопки: у пользователя общая корзина токенов
+throttling = Throttling(THROTTLE_RATE, THROTTLE_BURST, MAX_CONCURRENT_UPDATES, MAX_WAITING_UPDATES, exempt=(ADMIN_ID,))
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics(label=callback_label))
+dp.message.middleware(LogContext())
+dp.callback_query.middleware(LogContext(label=callback_label))
+bot.session.middleware(TelegramMetrics())
+
+REGISTRY.describe("db_commit_queue", "gauge", "Операции в очереди группового коммита")
+REGISTRY.describe("key_pool_size", "gauge", "Готовые ключи в пуле по серверам")
+REGISTRY.describe("cache_hits_total", "counter", "Попадания в кэши")
+REGISTRY.describe("cache_misses_total", "counter", "Промахи кэшей")
+REGISTRY.describe("bot_updates_throttled_total", "counter", "Обновления, отброшенные защитой от флуда")
+REGISTRY.describe("throttle_tracked_users", "gauge", "Пользователи с активной корзиной токенов")
+REGISTRY.describe("log_records_dropped_total", "counter", "Записи лога, отброшенные из-за переполненной очереди")
+REGISTRY.describe("log_records_suppressed_total", "counter", "Повторяющиеся записи лога, подавленные прореживанием")
+
+def collect_gauges():
+    REGISTRY.set("db_commit_queue", value=db.commit_queue.qsize())
+    for server_id, size in key_pool.sizes.items():
+        REGISTRY.set("key_pool_size", (("server", server_id),), size)
+    for name, cache in (("profiles", db.profiles), ("subscriptions", subscriptions)):
+        REGISTRY.set_total("cache_hits_total", (("cache", name),), cache.hits)
+        REGISTRY.set_total("cache_misses_total", (("cache", name),), cache.misses)
+    for reason, count in throttling.dropped.items():
+        REGISTRY.set_total("bot_updates_throttled_total", (("reason", reason),), count)
+    REGISTRY.set("throttle_tracked_users", value=len(throttling.buckets))
+    REGISTRY.set_total("log_records_dropped_total", value=logs.dropped)
+    REGISTRY.set_total("log_records_suppressed_total", value=logs.suppressed)
+
+# Состояния ввода для админ-панели
+class BroadcastForm(StatesGroup):
+    text = State()
+
+# Выдача ключа: выбираем сервер, регистрируем ключ на узле и сохраняем в базе
+async def provision_key():
+    server_id = await db.get_least_loaded_server()
+    if not server_id:
+        return None
+    template = await db.get_template(server_id)
+    if template is None:
+        return None
+    # Обычно ключ берётся из пула, уже зарегистрированным на узле; пустой пул — регистрируем сразу
+    key = await key_pool.claim(server_id)
+    if key is None:
+        key = generate_key()
+        if not await nodes.add_user(template.ip, template.port, key):
+            return None
+    return server_id, key, template.uri(key)
+
+async def issue_key(user_id, days, paid=False):
+    provisioned = await provision_key()
+    if not provisioned:
+        return None
+    server_id, key, link = provisioned
+    expires_at = get_expiration_ts(days)
+    await db.add_key(user_id, key, expires_at, server_id, paid)
+    return link, expires_at
+
+# Выдача ключа по подтверждённому платежу (вызывается из PaymentReconciler)
+async def complete_payment(payment_id, user_id, tariff, amount, days):
+    # Ключ не выдаётся, если платёж уже закрыт: иначе он остался бы на узле без записи в базе
+    if not await db.payment_pending(payment_id):
+        return True
+    provisioned = await provision_key()
+    if not provisioned:
+        return False  # повторим при следующей проверке
+    server_id, key, link = provisioned
+    expires_at = get_expiration_ts(days)
+
+    # Начисляем бонус рефереру (30% от суммы)
+    referral_id = await db.get_referral_id(user_id)
+    bonus = amount * 0.30 if referral_id else 0
+    if not await db.complete_payment(payment_id, user_id, key, expires_at, server_id, referral_id, bonus):
+        await key_pool.release(server_id, key)  # платёж уже обработан ранее, ключ не нужен
+        return True
+
+    await bot.send_message(user_id, f"Оплата успешна! Ваш ключ:\n\n`{link}`\n\nДействителен до: {format_expiration(expires_at)}", parse_mode="Markdown")
+    await bot.send_message(user_id, "Вот инструкция по настройке:", reply_markup=INSTRUCTION_MENU)
+    if referral_id:
+        await bot.send_message(referral_id, f"🎉 Вы получили {bonus} руб. за приглашение пользователя {user_id}!")
+    return True
 
 # Команда /start
 @dp.message(Command("start"))
 async def start(message: types.Message):
     user_id = message.from_user.id
-    if not db.user_exists(user_id):
-        db.add_user(user_id)
+    if not await db.user_exists(user_id):
+        await db.add_user(user_id)
 
     # Обработка реферальной ссылки
     args = message.text.split()[1:]  # Получаем аргументы после команды
@@ -106,120 +224,101 @@ async def start(message: types.Message):
                 await message.answer("Вы не можете пригласить сами себя.")
                 return
 
-            db.add_referral(user_id, referral_id)
+            # Реферер назначается только один раз: повторный /start по ссылке не даёт новый ключ
+            if not await db.add_referral(user_id, referral_id):
+                await message.answer("Добро пожаловать! Выберите действие:", reply_markup=MAIN_MENU)
+                return
 
             # Выдаём 1 день бесплатного VPN
-            server_id = db.get_least_loaded_server()
-            if server_id:
-                key = generate_key()
-                expires_at = get_expiration_date(days=1)
-                db.add_key(user_id, key, expires_at, server_id)
-                await message.answer(f"🎉 Вам выдан бесплатный ключ на 1 день:\n\n`{key}`\n\nДействителен до: {expires_at}", parse_mode="Markdown")
+            issued = await issue_key(user_id, days=1)
+            if issued:
+                link, expires_at = issued
+                await message.answer(f"🎉 Вам выдан бесплатный ключ на 1 день:\n\n`{link}`\n\nДействителен до: {format_expiration(expires_at)}", parse_mode="Markdown")
 
         except (IndexError, ValueError):
             logger.warning(f"Не удалось обработать реферальный ID: {args}")
 
-    await message.answer("Добро пожаловать! Выберите действие:", reply_markup=get_main_menu())
+    await message.answer("Добро пожаловать! Выберите действие:", reply_markup=MAIN_MENU)
 
 # Обработка нажатия на кнопку "Бесплатный VPN"
-@dp.callback_query(F.data == "get_key")
+@router.route("get_key")
 async def handle_get_key(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
 
-        if db.key_exists(user_id):
+        if await db.key_exists(user_id):
             await callback.answer("Вы уже получали пробный ключ. Повторная выдача невозможна.", show_alert=True)
             return
 
-        server_id = db.get_least_loaded_server()
-        if not server_id:
+        issued = await issue_key(user_id, days=1)  # 1 день бесплатного VPN
+        if not issued:
             await callback.answer("Нет доступных серверов.", show_alert=True)
             return
 
-        key = generate_key()
-        expires_at = get_expiration_date(days=1)  # 1 день бесплатного VPN
-        db.add_key(user_id, key, expires_at, server_id)
-        await callback.message.answer(f"Ваш пробный ключ:\n\n`{key}`\n\nДействителен до: {expires_at}", parse_mode="Markdown")
-        await callback.message.answer("Вот инструкция по настройке:", reply_markup=get_instruction_menu())
+        link, expires_at = issued
+        await callback.message.answer(f"Ваш пробный ключ:\n\n`{link}`\n\nДействителен до: {format_expiration(expires_at)}", parse_mode="Markdown")
+        await callback.message.answer("Вот инструкция по настройке:", reply_markup=INSTRUCTION_MENU)
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_get_key: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
 
 # Обработка нажатия на кнопку "Купить/Продлить VPN"
-@dp.callback_query(F.data == "buy_vpn")
+@router.route("buy_vpn")
 async def handle_buy_vpn(callback: types.CallbackQuery):
-    await callback.message.answer("Выберите тариф:", reply_markup=get_payment_menu())
+    await callback.message.answer("Выберите тариф:", reply_markup=catalog.snapshot.payment_menu)
     await callback.answer()
 
 # Обработка выбора тарифа
-@dp.callback_query(F.data.startswith("buy_"))
-async def handle_buy_tariff(callback: types.CallbackQuery):
+@router.route("buy", str)
+async def handle_buy_tariff(callback: types.CallbackQuery, tariff_name):
     try:
         user_id = callback.from_user.id
-        tariff = callback.data
-
-        if tariff == "buy_1_month":
-            amount = 300
-            description = "Оплата VPN на 1 месяц"
-            days = 30
-        elif tariff == "buy_3_months":
-            amount = 800
-            description = "Оплата VPN на 3 месяца"
-            days = 90
-        elif tariff == "buy_6_months":
-            amount = 1500
-            description = "Оплата VPN на 6 месяцев"
-            days = 180
-        else:
+        tariff = catalog.get(tariff_name)
+        if tariff is None:
             await callback.answer("Неверный тариф.", show_alert=True)
             return
 
-        # Создаём "платёж"
+        amount = tariff.amount
+        description = f"Оплата VPN на {tariff.title}"
+        days = tariff.days
+
+        # Создаём платёж; ключ выдаст PaymentReconciler после подтверждения оплаты
         payment = await create_payment(amount, description)
         payment_url = payment["confirmation"]["confirmation_url"]
-
-        # Отправляем пользователю "ссылку на оплату"
-        await callback.message.answer(f"Оплатите {amount} руб. по ссылке:\n\n{payment_url}")
-
-        # Для тестирования сразу выдаём ключ
-        server_id = db.get_least_loaded_server()
-        if not server_id:
-            await callback.answer("Нет доступных серверов.", show_alert=True)
+        if not await db.add_pending_payment(payment["id"], user_id, tariff.tariff, amount, days, int(time.time())):
+            await callback.answer("Произошла ошибка. Попробуйте позже.")
             return
 
-        key = generate_key()
-        expires_at = get_expiration_date(days)
-        db.add_key(user_id, key, expires_at, server_id)
-        await callback.message.answer(f"Оплата успешна! Ваш ключ:\n\n`{key}`\n\nДействителен до: {expires_at}", parse_mode="Markdown")
-        await callback.message.answer("Вот инструкция по настройке:", reply_markup=get_instruction_menu())
-
-        # Начисляем бонус рефереру (30% от суммы)
-        referral_id = db.get_referral_id(user_id)
-        if referral_id:
-            bonus = amount * 0.30  # 30% от суммы
-            db.add_earned(referral_id, bonus)
-            await bot.send_message(referral_id, f"🎉 Вы получили {bonus} руб. за приглашение пользователя {user_id}!")
-
+        # Отправляем пользователю ссылку на оплату
+        await callback.message.answer(
+            f"Оплатите {amount:g} руб. по ссылке:\n\n{payment_url}\n\n"
+            f"Ключ будет выдан автоматически после подтверждения оплаты."
+        )
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_buy_tariff: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
 
 # Обработка нажатия на кнопку "Мои ключи"
-@dp.callback_query(F.data == "my_keys")
+@router.route("my_keys")
 async def handle_my_keys(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        keys = db.get_user_keys(user_id)
+        keys = await db.get_user_keys(user_id)
 
         if not keys:
             await callback.answer("У вас нет активных ключей.", show_alert=True)
             return
 
         response = "Ваши ключи:\n\n"
-        for key, expires_at in keys:
-            response += f"Ключ: `{key}`\nДействителен до: {expires_at}\n\n"
+        # Ссылки собираются по закэшированным шаблонам серверов, без запроса на каждый ключ
+        links = await db.build_uris([(key, server_id) for key, _, server_id in keys])
+        for link, (_, expires_at, _) in zip(links, keys):
+            response += f"Ключ: `{link}`\nДействителен до: {format_expiration(expires_at)}\n\n"
+        token = await db.get_sub_token(user_id)
+        if token:
+            response += f"Подписка (все ключи сразу, обновляется автоматически):\n`{SUB_URL}/sub/{token}`"
 
         await callback.message.answer(response, parse_mode="Markdown")
         await callback.answer()
@@ -228,13 +327,13 @@ async def handle_my_keys(callback: types.CallbackQuery):
         await callback.answer("Произошла ошибка. Попробуйте позже.")
 
 # Обработка нажатия на кнопку "Реферальная программа"
-@dp.callback_query(F.data == "referral")
+@router.route("referral")
 async def handle_referral(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        bot_info = await callback.bot.get_me()
+        bot_info = await callback.bot.me()  # запрашивается при запуске и дальше берётся из кэша
         referral_link = generate_referral_link(bot_info.username, user_id)
-        referral_info = get_referral_info(db, user_id)
+        referral_info = await get_referral_info(db, user_id)
 
         response = (
             f"👋 Ваша реферальная ссылка:\n\n"
@@ -242,132 +341,183 @@ async def handle_referral(callback: types.CallbackQuery):
             f"{referral_info}\n\n"
             f"💡 Приглашайте друзей и получайте бонусы!"
         )
-        await callback.message.answer(response, reply_markup=get_referral_menu())
+        await callback.message.answer(response, reply_markup=REFERRAL_MENU)
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_referral: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
 
 # Обработка нажатия на кнопку "Вывести средства"
-@dp.callback_query(F.data == "withdraw_earned")
+@router.route("withdraw_earned")
 async def handle_withdraw_earned(callback: types.CallbackQuery):
     try:
         user_id = callback.from_user.id
-        earned = db.get_earned(user_id)
+        # Переводим заработанные средства на баланс одной транзакцией
+        earned = await db.withdraw_earned(user_id)
 
         if earned <= 0:
             await callback.answer("У вас нет средств для вывода.", show_alert=True)
             return
 
-        # Переводим заработанные средства на баланс
-        db.add_balance(user_id, earned)
-        db.add_earned(user_id, -earned)  # Обнуляем заработанные средства
-
         await callback.message.answer(f"💵 {earned} руб. переведены на ваш баланс.")
         await callback.answer()
     except Exception as e:
         logger.error(f"Ошибка в handle_withdraw_earned: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
 
-# Меню реферальной программы
-def get_referral_menu():
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="💵 Вывести средства", callback_data="withdraw_earned")
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
-        ]
-    ])
-    return keyboard
-
 # Команда /admin
 @dp.message(Command("admin"))
 async def admin_panel(message: types.Message):
     if message.from_user.id == ADMIN_ID:
-        await message.answer("Админ-панель:", reply_markup=get_admin_menu())
+        await message.answer("Админ-панель:", reply_markup=ADMIN_MENU)
     else:
         await message.answer("У вас нет доступа к этой команде.")
 
 # Обработка нажатия на кнопку "Назад" (в основном меню)
-@dp.callback_query(F.data == "back_to_main")
+@router.route("back_to_main")
 async def handle_back_to_main(callback: types.CallbackQuery):
-    await callback.message.answer("Главное меню:", reply_markup=get_main_menu())
+    await callback.message.answer("Главное меню:", reply_markup=MAIN_MENU)
     await callback.answer()
 
 # Обработчики для админ-панели
-@dp.callback_query(F.data == "admin_stats")
+@router.route("admin_stats")
 async def handle_admin_stats(callback: types.CallbackQuery):
     try:
-        total_users = len(db.get_all_users())
-        total_keys = len(db.get_all_keys())
-        stats = f"📊 Статистика:\n\n👥 Пользователей: {total_users}\n🔑 Ключей: {total_keys}"
-        await callback.message.answer(stats)
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("У вас нет доступа к этой команде.", show_alert=True)
+            return
+        stats = await stats_cache.get()
+        if stats is None:
+            await callback.answer("Не удалось получить статистику.", show_alert=True)
+            return
+        await callback.message.answer(format_stats(stats))
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_stats: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_give_key")
+@router.route("admin_referrals")
+async def handle_admin_referrals(callback: types.CallbackQuery):
+    try:
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("У вас нет доступа к этой команде.", show_alert=True)
+            return
+        await callback.message.answer(format_leaderboard(await leaderboard.get()))
+    except Exception as e:
+        logger.error(f"Ошибка в handle_admin_referrals: {e}")
+        await callback.answer("Произошла ошибка. Попробуйте позже.")
+    await callback.answer()
+
+@router.route("admin_give_key")
 async def handle_admin_give_key(callback: types.CallbackQuery):
     try:
-        await callback.message.answer("Введите ID пользователя и срок действия ключа (в днях):")
-        # Здесь можно добавить логику для ожидания ввода пользователя
+        await callback.message.answer(
+            "Отправьте файл CSV или TXT с подписью give_keys ДНИ.\n"
+            "В каждой строке — ID пользователя и, при необходимости, свой срок в днях: 123456789,30"
+        )
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_give_key: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_block_user")
+@router.route("admin_block_user")
 async def handle_admin_block_user(callback: types.CallbackQuery):
     try:
-        await callback.message.answer("Введите ID пользователя для блокировки:")
-        # Здесь можно добавить логику для ожидания ввода пользователя
+        await callback.message.answer("Отправьте файл CSV или TXT с подписью block_users, по одному ID пользователя в строке.")
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_block_user: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_manage_servers")
+@router.route("admin_manage_servers")
 async def handle_admin_manage_servers(callback: types.CallbackQuery):
     try:
-        await callback.message.answer("Управление серверами:", reply_markup=get_servers_menu())
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("У вас нет доступа к этой команде.", show_alert=True)
+            return
+        await callback.message.answer(f"Управление серверами:\n\n{format_health(health)}", reply_markup=SERVERS_MENU)
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_manage_servers: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_broadcast")
-async def handle_admin_broadcast(callback: types.CallbackQuery):
+@router.route("admin_broadcast")
+async def handle_admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
     try:
+        if callback.from_user.id != ADMIN_ID:
+            await callback.answer("У вас нет доступа к этой команде.", show_alert=True)
+            return
+        await state.set_state(BroadcastForm.text)
         await callback.message.answer("Введите сообщение для рассылки:")
-        # Здесь можно добавить логику для ожидания ввода пользователя
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_broadcast: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
-@dp.callback_query(F.data == "admin_edit_prices")
+@dp.message(BroadcastForm.text)
+async def handle_broadcast_text(message: types.Message, state: FSMContext):
+    try:
+        await state.clear()
+        if not message.text:
+            await message.answer("Рассылка поддерживает только текстовые сообщения.")
+            return
+        await broadcaster.start(message.html_text, message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка в handle_broadcast_text: {e}")
+        await message.answer("Произошла ошибка. Попробуйте позже.")
+
+@router.route("admin_edit_prices")
 async def handle_admin_edit_prices(callback: types.CallbackQuery):
     try:
-        await callback.message.answer("Редактирование цен:", reply_markup=get_prices_menu())
+        await callback.message.answer("Редактирование цен:", reply_markup=catalog.snapshot.prices_menu)
     except Exception as e:
         logger.error(f"Ошибка в handle_admin_edit_prices: {e}")
         await callback.answer("Произошла ошибка. Попробуйте позже.")
     await callback.answer()
 
+@router.route("edit_price", str)
+async def handle_admin_edit_price(callback: types.CallbackQuery, tariff_name):
+    tariff = catalog.get(tariff_name)
+    if tariff is None:
+        await callback.answer("Неверный тариф.", show_alert=True)
+        return
+    await callback.message.answer(
+        f"Текущая цена тарифа «{tariff.title}»: {tariff.amount:g} руб.\n"
+        f"Чтобы изменить, отправьте: edit_price {tariff.tariff} новая_цена"
+    )
+    await callback.answer()
+
+@router.route("admin_add_server")
+async def handle_admin_add_server(callback: types.CallbackQuery):
+    await callback.message.answer("Отправьте: add_server IP Порт Протокол [Ёмкость]")
+    await callback.answer()
+
+@router.route("admin_remove_server")
+async def handle_admin_remove_server(callback: types.CallbackQuery):
+    await callback.message.answer("Отправьте: remove_server ID_сервера")
+    await callback.answer()
+
+# Обработка нажатия на кнопку "Назад" (в админ-панели)
+@router.route("back_to_admin")
+async def handle_back_to_admin(callback: types.CallbackQuery):
+    await callback.message.answer("Админ-панель:", reply_markup=ADMIN_MENU)
+    await callback.answer()
+
 # Обработка добавления сервера
 @dp.message(F.text.startswith("add_server"))
 async def handle_add_server(message: types.Message):
     try:
+        if message.from_user.id != ADMIN_ID:
+            return
         parts = message.text.split()
-        if len(parts) != 4:
-            await message.answer("Неверный формат. Используйте: add_server IP Порт Протокол")
+        if len(parts) not in (4, 5):
+            await message.answer("Неверный формат. Используйте: add_server IP Порт Протокол [Ёмкость]")
             return
 
-        _, ip, port, protocol = parts
-        db.add_server(ip, int(port), protocol)
-        await message.answer(f"Сервер добавлен: {ip}:{port} ({protocol})")
+        _, ip, port, protocol = parts[:4]
+        capacity = int(parts[4]) if len(parts) == 5 else DEFAULT_CAPACITY
+        await db.add_server(ip, int(port), protocol, capacity)
+        await message.answer(f"Сервер добавлен: {ip}:{port} ({protocol}), ёмкость {capacity} ключей")
     except Exception as e:
         logger.error(f"Ошибка при добавлении сервера: {e}")
         await message.answer("Произошла ошибка. Проверьте формат данных.")
@@ -376,121 +526,227 @@ async def handle_add_server(message: types.Message):
 @dp.message(F.text.startswith("remove_server"))
 async def handle_remove_server(message: types.Message):
     try:
+        if message.from_user.id != ADMIN_ID:
+            return
         parts = message.text.split()
         if len(parts) != 2:
             await message.answer("Неверный формат. Используйте: remove_server ID_сервера")
             return
 
         _, server_id = parts
-        db.update_server_status(int(server_id), "inactive")
+        await db.update_server_status(int(server_id), "inactive")
         await message.answer(f"Сервер с ID {server_id} удален.")
     except Exception as e:
         logger.error(f"Ошибка при удалении сервера: {e}")
         await message.answer("Произошла ошибка. Проверьте ID сервера.")
 
+# Обработка изменения параметров подключения сервера
+@dp.message(F.text.startswith("set_server"))
+async def handle_set_server(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        parts = message.text.split()
+        if len(parts) < 3 or not all("=" in part for part in parts[2:]):
+            await message.answer(
+                "Неверный формат. Используйте: set_server ID_сервера параметр=значение ...\n"
+                f"Параметры: {', '.join(SERVER_SETTINGS)}"
+            )
+            return
+
+        server_id = int(parts[1])
+        settings = dict(part.split("=", 1) for part in parts[2:])
+        unknown = set(settings) - set(SERVER_SETTINGS)
+        if unknown:
+            await message.answer(f"Неизвестные параметры: {', '.join(sorted(unknown))}")
+            return
+        if "vless_port" in settings:
+            settings["vless_port"] = int(settings["vless_port"])
+        await db.update_server_settings(server_id, settings)
+        await message.answer(f"Параметры сервера {server_id} обновлены.")
+    except Exception as e:
+        logger.error(f"Ошибка при изменении параметров сервера: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
+# Массовые операции по файлу: выдача ключей и блокировка. Обработка идёт в фоне, результат придёт файлом
+@dp.message(F.document, F.caption.startswith("give_keys"))
+async def handle_bulk_give_keys(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        parts = message.caption.split()
+        if len(parts) > 2:
+            await message.answer("Неверный формат. Используйте подпись: give_keys ДНИ")
+            return
+
+        days = int(parts[1]) if len(parts) == 2 else None
+        bulk.start("give_keys", message.document, message.from_user.id, days)
+    except Exception as e:
+        logger.error(f"Ошибка при массовой выдаче ключей: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
+@dp.message(F.document, F.caption.startswith("block_users"))
+async def handle_bulk_block_users(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        bulk.start("block_users", message.document, message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка при массовой блокировке: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
+# Выгрузка таблиц файлом: export [users|keys|servers|all] [csv|jsonl]
+@dp.message(F.text.startswith("export"))
+async def handle_export(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        parsed = parse_export_args(message.text.split()[1:])
+        if parsed is None:
+            await message.answer("Неверный формат. Используйте: export [users|keys|servers|all] [csv|jsonl]")
+            return
+
+        tables, fmt = parsed
+        await message.answer(f"⏳ Готовим выгрузку: {', '.join(tables)} ({fmt})")
+        exporter.start(tables, fmt, message.from_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке данных: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
+# Внеочередная резервная копия базы
+@dp.message(F.text == "backup")
+async def handle_backup(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        path, size, elapsed = await backups.backup()
+        await message.answer(f"💾 Резервная копия {path}: {size / 1024 / 1024:.1f} МБ за {elapsed:.1f} сек.")
+    except Exception as e:
+        logger.error(f"Ошибка при резервном копировании: {e}")
+        await message.answer("Не удалось создать резервную копию.")
+
+# Реферальная сеть пользователя по уровням
+@dp.message(F.text.startswith("downline"))
+async def handle_downline(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        parts = message.text.split()
+        if len(parts) != 2:
+            await message.answer("Неверный формат. Используйте: downline ID_пользователя")
+            return
+
+        user_id = int(parts[1])
+        await message.answer(format_downline(user_id, await db.get_downline_levels(user_id)))
+    except Exception as e:
+        logger.error(f"Ошибка при получении реферальной сети: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
+# Обработка изменения ёмкости сервера
+@dp.message(F.text.startswith("set_capacity"))
+async def handle_set_capacity(message: types.Message):
+    try:
+        if message.from_user.id != ADMIN_ID:
+            return
+        parts = message.text.split()
+        if len(parts) != 3:
+            await message.answer("Неверный формат. Используйте: set_capacity ID_сервера Ёмкость")
+            return
+
+        _, server_id, capacity = parts
+        await db.update_server_capacity(int(server_id), int(capacity))
+        await message.answer(f"Ёмкость сервера {server_id} изменена: {capacity} ключей.")
+    except Exception as e:
+        logger.error(f"Ошибка при изменении ёмкости сервера: {e}")
+        await message.answer("Произошла ошибка. Проверьте формат данных.")
+
 # Обработка редактирования цен
 @dp.message(F.text.startswith("edit_price"))
 async def handle_edit_price(message: types.Message):
     try:
+        if message.from_user.id != ADMIN_ID:
+            return
         parts = message.text.split()
         if len(parts) != 3:
             await message.answer("Неверный формат. Используйте: edit_price тариф новая_цена")
             return
 
         _, tariff, new_price = parts
-        db.update_price(tariff, float(new_price))
+        amount = float(new_price)
+        # float() принимает и nan/inf: цена сразу попадает в каталог покупок, поэтому проверяем явно
+        if not math.isfinite(amount) or amount <= 0:
+            await message.answer("Цена должна быть положительным числом.")
+            return
+        if not await catalog.edit_price(tariff, amount):
+            tariffs = ", ".join(catalog.snapshot.by_name)
+            await message.answer(f"Неизвестный тариф {tariff}. Доступные тарифы: {tariffs}")
+            return
         await message.answer(f"Цена для тарифа {tariff} обновлена: {new_price} руб.")
     except Exception as e:
         logger.error(f"Ошибка при обновлении цены: {e}")
         await message.answer("Произошла ошибка. Проверьте формат данных.")
 
 # Обработка нажатия на кнопку "Инструкция"
-@dp.callback_query(F.data == "instruction")
+@router.route("instruction")
 async def handle_instruction(callback: types.CallbackQuery):
-    await callback.message.answer("Выберите вашу операционную систему:", reply_markup=get_instruction_menu())
-    await callback.answer()
-
-# Обработчики для инструкций
-@dp.callback_query(F.data == "instruction_android")
-async def handle_instruction_android(callback: types.CallbackQuery):
-    instruction = (
-        "Инструкция для Android:\n"
-        "1️⃣ Скопируйте ключ доступа;\n"
-        "2️⃣ Установите приложение 🌐V2rayNG;\n"
-        "3️⃣ Запустите программу V2rayNG и нажми ➕ в правом верхнем углу;\n"
-        "4️⃣ Выберите «Импорт из буфера обмена»;\n"
-        "5️⃣ Нажмите круглую кнопку включения и наслаждайтесь высокой скоростью и стабильностью."
-    )
-    await callback.message.answer(instruction)
-    await callback.answer()
-
-@dp.callback_query(F.data == "instruction_ios")
-async def handle_instruction_ios(callback: types.CallbackQuery):
-    instruction = (
-        "Инструкция для IOS:\n"
-        "1️⃣ Скопируйте ключ доступа;\n"
-        "2️⃣ Установите приложение 🌐Streisand;\n"
-        "3️⃣ Запустите программу Streisand и нажмите ➕ в правом верхнем углу;\n"
-        "4️⃣ Выберите «Добавить из буфера» (если программа спросит разрешение на вставку - разрешите);\n"
-        "5️⃣ Нажмите круглую кнопку включения внизу и наслаждайтесь высокой скоростью и стабильностью.\n\n"
-        "Также ты можешь настроить автоматическое ВКЛ/ВЫКЛ VPN при входе в Instagram (всё также, только нужно выбирать Streisand вместо WireGuard)."
-    )
-    await callback.message.answer(instruction)
-    await callback.answer()
-
-@dp.callback_query(F.data == "instruction_macos")
-async def handle_instruction_macos(callback: types.CallbackQuery):
-    instruction = (
-        "Инструкция для MacOS:\n"
-        "1️⃣ Скопируйте ключ доступа;\n"
-        "2️⃣ Скачайте и установите приложение 🌐V2Box;\n"
-        "3️⃣ Запустите программу V2Box и перейдите на вкладку «Configs» (снизу);\n"
-        "4️⃣ Далее нажмите ➕ в правом верхнем углу и выберите «Import v2ray uri from clipboard» (первый пункт в списке);\n"
-        "5️⃣ После перейдите на вкладку «Home» (снизу) и нажмите большую кнопку (снизу) «Tap to Connect»;\n"
-        "6️⃣ Наслаждайтесь высокой скоростью и стабильностью."
-    )
-    await callback.message.answer(instruction)
+    await callback.message.answer("Выберите вашу операционную систему:", reply_markup=INSTRUCTION_MENU)
     await callback.answer()
 
-@dp.callback_query(F.data == "instruction_windows")
-async def handle_instruction_windows(callback: types.CallbackQuery):
-    instruction = (
-        "Инструкция для Windows:\n"
-        "1️⃣ Скопируйте ключ доступа;\n"
-        "2️⃣ Установите последний релиз для своей ОС с GitHub;\n"
-        "3️⃣ Для Windows рекомендуем версию Portable или Setup. Запускайте программу с правами администратора;\n"
-        "4️⃣ Выберите регион: для РФ - “Россия”, для остальных - “Другой”;\n"
-        "5️⃣ Копируйте подписку и нажмите “Новый профиль”, затем “Добавить профиль из буфера обмена”;\n"
-        "6️⃣ Наслаждайся высокой скоростью и стабильностью!"
-    )
+# Обработчик инструкций: текст для выбранной ОС
+@router.route("instruction", str)
+async def handle_instruction_os(callback: types.CallbackQuery, os_name):
+    instruction = INSTRUCTIONS.get(os_name)
+    if instruction is None:
+        await callback.answer()
+        return
     await callback.message.answer(instruction)
     await callback.answer()
 
-@dp.callback_query(F.data == "instruction_tv")
-async def handle_instruction_tv(callback: types.CallbackQuery):
-    instruction = (
-        "Инструкция для TV:\n"
-        "1⃣ Установите приложение v2RayTun из GooglePlay;\n"
-        "2⃣ На телевизоре, в приложении v2RayTun на главном экране выберите Управление;\n"
-        "3⃣ Далее выберите Ручной ввод (если собираетесь руками вводить)/либо 'импорт из буфера обмена' если вы ее скопировали любым способом/либо 'Импорт из файла' (если копируете из блокнота)."
-    )
-    await callback.message.answer(instruction)
-    await callback.answer()
+# Кнопки в старых сообщениях: buy_1_month, instruction_android, edit_price_1_month
+router.alias("buy_", "buy")
+router.alias("instruction_", "instruction")
+router.alias("edit_price_", "edit_price")
 
-# Функция для проверки ключей
-async def check_expiring_keys():
-    while True:
-        keys = db.get_all_keys()
-        for user_id, key, expires_at in keys:
-            expires_date = datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
-            if (expires_date - datetime.now()).days == 1:
-                await bot.send_message(user_id, f"Ваш ключ истекает через 1 день:\n\n`{key}`\n\nПродлите его, чтобы продолжить использование.", parse_mode="Markdown")
-        await asyncio.sleep(3600)  # Проверка каждые 1 час
+# Единственный обработчик нажатий: маршрут выбирается по callback_data в CallbackRouter
+@dp.callback_query()
+async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
+    await router.dispatch(callback, state=state)
 
 # Запуск бота
 async def main():
-    asyncio.create_task(check_expiring_keys())  # Запуск проверки ключей
-    await dp.start_polling(bot)
+    # Без публичного адреса Telegram некуда отправлять обновления: бот молча ничего бы не получал
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+    await db.connect()
+    await catalog.load()
+    bot_info = await bot.me()
+    logger.info(f"Бот @{bot_info.username} запущен")
+    asyncio.create_task(expiry.run())  # Запуск напоминаний об истечении ключей
+    await broadcaster.resume()  # Продолжение прерванных рассылок
+    reconciler = PaymentReconciler(db, complete_payment)
+    asyncio.create_task(reconciler.run())  # Проверка оплаты счетов
+    asyncio.create_task(key_pool.run())  # Пополнение пула готовых ключей
+    asyncio.create_task(health.run())  # Проверка доступности узлов
+    asyncio.create_task(backups.run())  # Резервные копии базы по расписанию
+    sub_runner = await start_subscription_server(subscriptions, SUB_HOST, SUB_PORT)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT, collectors=(collect_gauges,))
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(
+                dp, bot, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+                WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_MAX_INFLIGHT
+            )
+        else:
+            # После работы в режиме webhook Telegram не отдаёт getUpdates, пока вебхук не снят
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await sub_runner.cleanup()
+        await metrics_runner.cleanup()
+        await nodes.close()
+        await health.close()
+        await close_payment_client()
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
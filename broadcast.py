@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500  # пользователей за одну выборку из базы (и между сохранениями прогресса)
+REPORT_INTERVAL = 5  # как часто обновлять сообщение с прогрессом, секунд
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # Telegram попросил подождать — останавливаем всех отправителей сразу
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+class Broadcaster:
+    def __init__(self, db, bot, rate=25, workers=8):
+        self.db = db
+        self.bot = bot
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+
+    async def start(self, text, admin_id):
+        total = await self.db.count_users()
+        broadcast_id = await self.db.create_broadcast(text, admin_id, total)
+        asyncio.create_task(self.run(broadcast_id, text, admin_id, total))
+
+    async def resume(self):
+        # Рассылки, прерванные перезапуском, продолжаются с последней сохранённой позиции
+        for broadcast_id, text, admin_id, total, last_user_id, sent, blocked, failed in await self.db.get_unfinished_broadcasts():
+            logger.info(f"Продолжаем рассылку {broadcast_id} с пользователя {last_user_id}")
+            asyncio.create_task(self.run(broadcast_id, text, admin_id, total, last_user_id, sent, blocked, failed))
+
+    async def run(self, broadcast_id, text, admin_id, total, last_user_id=0, sent=0, blocked=0, failed=0):
+        stats = {"sent": sent, "blocked": blocked, "failed": failed}
+        started = time.monotonic()
+        done_before = sent + blocked + failed
+        status = await self.bot.send_message(admin_id, f"📢 Рассылка #{broadcast_id} запущена. Получателей: {total}")
+        reporter = asyncio.create_task(self.report(status, broadcast_id, total, stats, started, done_before))
+        try:
+            while True:
+                user_ids = await self.db.get_user_ids_after(last_user_id, BATCH_SIZE)
+                if not user_ids:
+                    break
+                queue = asyncio.Queue()
+                for user_id in user_ids:
+                    queue.put_nowait(user_id)
+                await asyncio.gather(*(self.worker(queue, text, stats) for _ in range(self.workers)))
+                last_user_id = user_ids[-1]
+                await self.db.update_broadcast(broadcast_id, last_user_id, stats["sent"], stats["blocked"], stats["failed"])
+            await self.db.update_broadcast(broadcast_id, last_user_id, stats["sent"], stats["blocked"], stats["failed"], "finished")
+        except Exception as e:
+            logger.error(f"Ошибка в рассылке {broadcast_id}: {e}")
+        finally:
+            reporter.cancel()
+        elapsed = time.monotonic() - started
+        await self.edit_status(status, (
+            f"✅ Рассылка #{broadcast_id} завершена за {elapsed:.0f} сек.\n\n"
+            f"📨 Доставлено: {stats['sent']}\n"
+            f"🚫 Заблокировали бота: {stats['blocked']}\n"
+            f"⚠️ Ошибки: {stats['failed']}"
+        ))
+
+    async def worker(self, queue, text, stats):
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            while True:
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(user_id, text)
+                    stats["sent"] += 1
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Рассылка: флуд-контроль, ждём {e.retry_after} сек.")
+                    self.bucket.pause(e.retry_after)
+                    continue
+                except TelegramForbiddenError:
+                    stats["blocked"] += 1
+                except TelegramBadRequest as e:
+                    logger.warning(f"Рассылка: не удалось отправить пользователю {user_id}: {e}")
+                    stats["failed"] += 1
+                except Exception as e:
+                    logger.error(f"Рассылка: ошибка при отправке пользователю {user_id}: {e}")
+                    stats["failed"] += 1
+                break
+
+    async def report(self, status, broadcast_id, total, stats, started, done_before):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            done = stats["sent"] + stats["blocked"] + stats["failed"]
+            speed = (done - done_before) / max(time.monotonic() - started, 1e-9)
+            eta = (total - done) / speed if speed > 0 else 0
+            await self.edit_status(status, (
+                f"📢 Рассылка #{broadcast_id}: {done} из {total}\n\n"
+                f"⚡ Скорость: {speed:.1f} сообщ./сек.\n"
+                f"⏳ Осталось: ~{max(eta, 0):.0f} сек.\n"
+                f"🚫 Заблокировали бота: {stats['blocked']}, ⚠️ ошибки: {stats['failed']}"
+            ))
+
+    async def edit_status(self, status, text):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус рассылки: {e}")
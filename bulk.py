@@ -0,0 +1,207 @@
+import asyncio
+import codecs
+import csv
+import io
+import logging
+import re
+import time
+from datetime import datetime
+
+from aiogram.types import BufferedInputFile
+
+from vless_generator import generate_key, get_expiration_ts, format_expiration
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500  # строк в одной транзакции
+PROGRESS_INTERVAL = 2  # секунд между обновлениями сообщения о ходе обработки
+DOWNLOAD_TIMEOUT = 600  # файл читается по мере обработки, поэтому тайм-аут с запасом
+SEPARATORS = re.compile(r"[,;\s\"']+")
+
+async def file_chunks(bot, file_path):
+    if bot.session.api.is_local:
+        # Локальный сервер Bot API отдаёт путь к файлу на диске
+        with open(bot.session.api.wrap_local_file.to_local(file_path), "rb") as file:
+            while chunk := file.read(65536):
+                yield chunk
+    else:
+        url = bot.session.api.file_url(bot.token, file_path)
+        async for chunk in bot.session.stream_content(url, timeout=DOWNLOAD_TIMEOUT, raise_for_status=True):
+            yield chunk
+
+async def read_lines(bot, document):
+    # Файл скачивается и разбирается по частям: в памяти нет ни всего файла, ни всех строк
+    file = await bot.get_file(document.file_id)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in file_chunks(bot, file.file_path):
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+def parse_row(line, default_days):
+    # Строка: ID пользователя и, для выдачи ключей, срок в днях. Разделители — запятая, точка с запятой, пробелы;
+    # кавычки CSV отбрасываются
+    fields = [field for field in SEPARATORS.split(line.strip()) if field]
+    if not fields:
+        return None
+    user_id = int(fields[0])
+    days = int(fields[1]) if len(fields) > 1 else default_days
+    return user_id, days
+
+class BulkJob:
+    def __init__(self, title, columns):
+        self.title = title
+        self.stats = {"ok": 0, "failed": 0, "skipped": 0}
+        self.output = io.StringIO()
+        self.writer = csv.writer(self.output)
+        self.writer.writerow(columns)
+        self.width = len(columns)
+        self.started = time.monotonic()
+
+    def result(self, status, *values):
+        # Статус — всегда в последней колонке
+        self.writer.writerow((*values, *[""] * (self.width - 1 - len(values)), status))
+        if status == "ok":
+            self.stats["ok"] += 1
+        elif status in ("duplicate", "header"):
+            self.stats["skipped"] += 1
+        else:
+            self.stats["failed"] += 1
+
+    def summary(self, done=False):
+        elapsed = time.monotonic() - self.started
+        processed = sum(self.stats.values())
+        head = f"✅ {self.title}: готово за {elapsed:.1f} сек." if done else f"⏳ {self.title}: обработано {processed} строк"
+        return (
+            f"{head}\n\n"
+            f"Успешно: {self.stats['ok']}\n"
+            f"Пропущено: {self.stats['skipped']}\n"
+            f"Ошибки: {self.stats['failed']}"
+        )
+
+class BulkOperations:
+    # Массовая выдача ключей и блокировка по файлу от админа. Строки обрабатываются пачками
+    # по CHUNK_SIZE: одна транзакция на пачку, ключи распределяются по серверам сразу на всю пачку,
+    # регистрация на узлах идёт параллельно
+    def __init__(self, db, nodes, bot, node_batch=100):
+        self.db = db
+        self.nodes = nodes
+        self.bot = bot
+        self.node_batch = node_batch  # ключей в одном запросе к узлу
+
+    def start(self, operation, document, admin_id, days=None):
+        asyncio.create_task(self.run(operation, document, admin_id, days))
+
+    async def run(self, operation, document, admin_id, days):
+        if operation == "give_keys":
+            job = BulkJob("Выдача ключей", ("line", "user_id", "days", "server_id", "link", "expires", "status"))
+            process = self.give_keys
+        else:
+            job = BulkJob("Блокировка", ("line", "user_id", "removed_keys", "status"))
+            process = self.block_users
+        status = await self.bot.send_message(admin_id, f"⏳ {job.title}: файл {document.file_name} принят")
+        reporter = asyncio.create_task(self.report(status, job))
+        try:
+            seen = set()
+            chunk = []
+            line_no = 0
+            async for line in read_lines(self.bot, document):
+                line_no += 1
+                try:
+                    row = parse_row(line, days)
+                except ValueError:
+                    # Первая строка может быть заголовком CSV
+                    job.result("header" if line_no == 1 else "invalid", line_no, line.strip())
+                    continue
+                if row is None:
+                    continue
+                user_id, row_days = row
+                if user_id in seen:
+                    job.result("duplicate", line_no, user_id)
+                    continue
+                seen.add(user_id)
+                chunk.append((line_no, user_id, row_days))
+                if len(chunk) >= CHUNK_SIZE:
+                    await process(job, chunk)
+                    chunk = []
+            if chunk:
+                await process(job, chunk)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке файла {document.file_name}: {e}")
+            job.result("aborted", line_no, str(e))
+        finally:
+            reporter.cancel()
+        await self.edit_status(status, job.summary(done=True))
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{document.file_name.rsplit('.', 1)[0]}_result.csv"
+        # BOM — чтобы Excel открыл файл в UTF-8
+        await self.bot.send_document(admin_id, BufferedInputFile(job.output.getvalue().encode("utf-8-sig"), filename=name))
+        logger.info(f"{job.title} из файла {document.file_name}: {job.stats}")
+
+    async def give_keys(self, job, rows):
+        for line_no, user_id, days in [row for row in rows if not row[2] or row[2] <= 0]:
+            job.result("invalid_days", line_no, user_id, days)
+        rows = [row for row in rows if row[2] and row[2] > 0]
+        servers = self.db.allocator.plan(len(rows))
+        for line_no, user_id, days in rows[len(servers):]:
+            job.result("no_capacity", line_no, user_id, days)
+
+        by_server = {}
+        for row, server_id in zip(rows, servers):
+            by_server.setdefault(server_id, []).append((row, generate_key()))
+        registered = await asyncio.gather(*(self.register(server_id, part) for server_id, part in by_server.items()))
+
+        items = []
+        links = {}
+        for server_id, template, part, results in registered:
+            for (row, key), ok in zip(part, results):
+                line_no, user_id, days = row
+                if not ok:
+                    job.result("node_error", line_no, user_id, days, server_id)
+                    continue
+                expires_at = get_expiration_ts(days)
+                items.append((user_id, key, expires_at, server_id, False))
+                links[key] = (row, server_id, template.uri(key), expires_at)
+        if not items:
+            return
+        saved = await self.db.add_keys(items)
+        for user_id, key, *_ in items:
+            (line_no, _, days), server_id, link, expires_at = links[key]
+            if saved:
+                job.result("ok", line_no, user_id, days, server_id, link, format_expiration(expires_at))
+            else:
+                job.result("db_error", line_no, user_id, days, server_id)
+
+    async def register(self, server_id, part):
+        # Ключи одного сервера уходят на узел запросами по node_batch, запросы — параллельно
+        template = await self.db.get_template(server_id)
+        if template is None:
+            return server_id, None, part, [False] * len(part)
+        batches = [part[i:i + self.node_batch] for i in range(0, len(part), self.node_batch)]
+        results = await asyncio.gather(*(
+            self.nodes.add_users(template.ip, template.port, [key for _, key in batch]) for batch in batches
+        ))
+        return server_id, template, part, [ok for batch, ok in zip(batches, results) for _ in batch]
+
+    async def block_users(self, job, rows):
+        removed = await self.db.block_users([user_id for _, user_id, _ in rows])
+        for line_no, user_id, _ in rows:
+            if removed is None:
+                job.result("db_error", line_no, user_id)
+            else:
+                job.result("ok", line_no, user_id, removed[user_id])
+
+    async def report(self, status, job):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self.edit_status(status, job.summary())
+
+    async def edit_status(self, status, text):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус обработки файла: {e}")
@@ -0,0 +1,64 @@
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = ":"
+
+def callback_data(name, *params):
+    # Формат данных кнопки: имя[:параметр...], например "buy:1_month"
+    return SEPARATOR.join((name, *map(str, params)))
+
+class CallbackRouter:
+    # Нажатия кнопок разбираются одним поиском в словаре по имени маршрута,
+    # вместо последовательной проверки фильтров каждого обработчика
+    def __init__(self):
+        # (имя, число параметров) -> (обработчик, типы параметров, имена дополнительных аргументов):
+        # "instruction" и "instruction:android" — разные маршруты
+        self.routes = {}
+        # Старый формат кнопок "префикс_параметр" (buy_1_month) -> имя маршрута с одним параметром:
+        # такие кнопки остаются в уже отправленных сообщениях
+        self.legacy = {}
+
+    def route(self, name, *types):
+        if SEPARATOR in name:
+            raise ValueError(f"Имя маршрута не может содержать '{SEPARATOR}': {name}")
+
+        def register(handler):
+            if (name, len(types)) in self.routes:
+                raise ValueError(f"Маршрут {name} с {len(types)} параметрами уже зарегистрирован")
+            # Дополнительные аргументы (например, state) передаются, только если обработчик их объявил
+            parameters = list(inspect.signature(handler).parameters)[1 + len(types):]
+            self.routes[name, len(types)] = (handler, types, frozenset(parameters))
+            return handler
+        return register
+
+    def alias(self, prefix, name):
+        self.legacy[prefix] = name
+
+    def resolve(self, data):
+        name, *raw = (data or "").split(SEPARATOR)
+        route = self.routes.get((name, len(raw)))
+        if route is None and not raw:
+            for prefix, target in self.legacy.items():
+                if name.startswith(prefix) and len(name) > len(prefix):
+                    raw = [name[len(prefix):]]
+                    route = self.routes.get((target, 1))
+                    break
+        if route is None:
+            return None
+        handler, types, wanted = route
+        try:
+            params = [convert(value) for convert, value in zip(types, raw)]
+        except ValueError:
+            return None
+        return handler, params, wanted
+
+    async def dispatch(self, callback, **data):
+        resolved = self.resolve(callback.data)
+        if resolved is None:
+            logger.warning(f"Неизвестная кнопка: {callback.data!r}")
+            await callback.answer()
+            return
+        handler, params, wanted = resolved
+        await handler(callback, *params, **{key: value for key, value in data.items() if key in wanted})
@@ -1,238 +1,930 @@
+import asyncio
 import sqlite3
 import logging
+import secrets
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import aiosqlite
+
+from server_allocator import ServerAllocator, DEFAULT_CAPACITY
+from migrations import migrate
+from expiry_scheduler import REMIND_BEFORE
+from profile_cache import ProfileCache, Profile, MISSING
+from vless_generator import ServerTemplate, TEMPLATE_COLUMNS
 
 logger = logging.getLogger(__name__)
 
+# Статусы серверов: active и degraded (медленный узел) получают новые ключи, down (узел не отвечает)
+# выставляется и снимается проверкой здоровья, inactive — только админом
+SERVING_STATUSES = ("active", "degraded")
+
+# Все вышестоящие рефереры пользователя, начиная с него самого. UNION останавливает обход на цикле
+ANCESTORS = (
+    "WITH RECURSIVE up(id) AS ("
+    "SELECT ? UNION SELECT u.referral_id FROM users u JOIN up ON u.user_id = up.id WHERE u.referral_id IS NOT NULL)"
+)
+REFERRAL_MAX_DEPTH = 20  # глубже по реферальному дереву отчёты не заходят
+
+# Выгрузки для админа: колонки в порядке вывода
+EXPORT_QUERIES = {
+    "users": (
+        "SELECT user_id, created_at, balance, earned, referral_id, referrals_direct, referrals_total, "
+        "revenue_direct, revenue_total FROM users ORDER BY user_id"
+    ),
+    "keys": "SELECT id, user_id, key, server_id, expires_ts, paid, reminded FROM keys ORDER BY id",
+    "servers": (
+        "SELECT id, ip, port, protocol, capacity, status, host, vless_port, transport, security, sni, label "
+        "FROM servers ORDER BY id"
+    ),
+}
+
+# Параметры подключения, которые админ может менять командой set_server
+SERVER_SETTINGS = ("host", "vless_port", "transport", "security", "sni", "flow", "public_key", "short_id", "fingerprint", "path", "label")
+
 class Database:
-    def __init__(self, db_file):
-        self.connection = sqlite3.connect(db_file)
-        self.cursor = self.connection.cursor()
-        self.create_tables()
-
-    def create_tables(self):
-        try:
-            # Таблица пользователей
-            self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                user_id INTEGER UNIQUE,
-                balance REAL DEFAULT 0,
-                earned REAL DEFAULT 0,  -- Заработанные средства
-                referral_id INTEGER DEFAULT NULL
-            )
-            """)
-            # Таблица ключей
-            self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS keys (
-                id INTEGER PRIMARY KEY,
-                user_id INTEGER,
-                key TEXT UNIQUE,
-                expires_at TEXT,
-                server_id INTEGER
-            )
-            """)
-            # Таблица серверов
-            self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS servers (
-                id INTEGER PRIMARY KEY,
-                ip TEXT UNIQUE,
-                port INTEGER,
-                protocol TEXT,
-                status TEXT DEFAULT 'active'
-            )
-            """)
-            # Таблица цен
-            self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS prices (
-                id INTEGER PRIMARY KEY,
-                tariff TEXT UNIQUE,
-                amount REAL
-            )
-            """)
-            # Индексы
-            self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON keys (user_id)")
-            self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_server_id ON keys (server_id)")
-            self.connection.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Ошибка при создании таблиц: {e}")
-
-    def user_exists(self, user_id):
-        try:
-            self.cursor.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
-            return self.cursor.fetchone() is not None
+    def __init__(self, db_file, readers=4):
+        self.db_file = db_file
+        self.readers_count = readers
+        self.writer = None
+        # Пул соединений для чтения: каждое соединение aiosqlite работает в своём потоке,
+        # поэтому запросы на чтение выполняются параллельно и не блокируют event loop
+        self.readers = asyncio.Queue()
+        # Все изменения идут через одно соединение и выполняются строго по очереди
+        self.write_lock = asyncio.Lock()
+        # Загрузка серверов считается в памяти и обновляется при выдаче/удалении ключей
+        self.allocator = ServerAllocator()
+        # Подписчики на изменения ключей: key_added(...) и keys_removed(user_id, key_ids)
+        self.key_listeners = []
+        # Профили часто запрашиваемых пользователей держим в памяти
+        self.profiles = ProfileCache()
+        # Шаблоны ссылок vless:// по серверам, сбрасываются при изменении сервера
+        self.templates = {}
+        self.template_generation = 0  # растёт при каждом изменении серверов: по нему сбрасываются подписки
+        # Групповой коммит: операции из разных обработчиков записываются одной транзакцией
+        self.commit_queue = asyncio.Queue()
+        self.commit_window = 0.002  # сколько ждать попутчиков для транзакции, секунд
+        self.commit_batch = 500
+        self.committer = None
+
+    async def connect(self):
+        self.writer = await aiosqlite.connect(self.db_file)
+        # WAL позволяет читателям работать одновременно с записью, а synchronous=NORMAL
+        # в режиме WAL делает fsync только при чекпоинте, не теряя целостности базы
+        await self.writer.execute("PRAGMA journal_mode=WAL")
+        await self.writer.execute("PRAGMA synchronous=NORMAL")
+        await self.writer.execute("PRAGMA cache_size=-16000")  # 16 МБ
+        await self.writer.execute("PRAGMA temp_store=MEMORY")
+        await self.writer.execute("PRAGMA busy_timeout=5000")
+        # Схема базы приводится к актуальной версии до начала работы
+        await migrate(self.writer)
+        for _ in range(self.readers_count):
+            connection = await aiosqlite.connect(self.db_file)
+            await connection.execute("PRAGMA query_only=1")
+            await connection.execute("PRAGMA cache_size=-8000")
+            await connection.execute("PRAGMA busy_timeout=5000")
+            self.readers.put_nowait(connection)
+        await self.load_allocator()
+        self.committer = asyncio.create_task(self.commit_loop())
+
+    async def close(self):
+        if self.committer is not None:
+            # Дожидаемся записи уже поставленных в очередь операций
+            await self.commit_queue.join()
+            self.committer.cancel()
+            self.committer = None
+        while not self.readers.empty():
+            connection = self.readers.get_nowait()
+            await connection.close()
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        connection = await self.readers.get()
+        try:
+            yield connection
+        finally:
+            self.readers.put_nowait(connection)
+
+    @asynccontextmanager
+    async def snapshot(self):
+        # Отдельное соединение для долгих чтений (выгрузки): не занимает пул читателей, а открытая
+        # транзакция чтения фиксирует снимок базы — все таблицы выгружаются на один момент времени
+        connection = await aiosqlite.connect(self.db_file)
+        try:
+            await connection.execute("PRAGMA query_only=1")
+            await connection.execute("BEGIN")
+            async with connection.execute("SELECT COUNT(*) FROM sqlite_master") as cursor:
+                await cursor.fetchone()  # снимок фиксируется первым чтением
+            yield connection
+        finally:
+            await connection.close()
+
+    async def export_rows(self, connection, table, batch=1000):
+        # Первым отдаётся список колонок, дальше — строки пачками по batch: память не зависит от размера таблицы
+        async with connection.execute(EXPORT_QUERIES[table]) as cursor:
+            yield [column[0] for column in cursor.description]
+            while rows := await cursor.fetchmany(batch):
+                yield rows
+
+    async def fetchone(self, query, params=()):
+        async with self.reader() as connection:
+            async with connection.execute(query, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, query, params=()):
+        async with self.reader() as connection:
+            async with connection.execute(query, params) as cursor:
+                return await cursor.fetchall()
+
+    # Все изменения проходят через очередь группового коммита (см. commit_loop)
+    async def execute(self, query, params=()):
+        async def operation(connection):
+            cursor = await connection.execute(query, params)
+            return cursor.lastrowid
+
+        return await self.submit(operation)
+
+    async def executemany(self, query, rows):
+        async def operation(connection):
+            await connection.executemany(query, rows)
+
+        await self.submit(operation)
+
+    async def submit(self, operation):
+        # operation — корутина operation(connection); результат возвращается после коммита
+        future = asyncio.get_running_loop().create_future()
+        self.commit_queue.put_nowait((operation, future))
+        return await future
+
+    async def commit_loop(self):
+        while True:
+            batch = [await self.commit_queue.get()]
+            await asyncio.sleep(self.commit_window)
+            while len(batch) < self.commit_batch and not self.commit_queue.empty():
+                batch.append(self.commit_queue.get_nowait())
+            try:
+                results = await self.commit_batch_operations(batch)
+            except Exception as e:
+                # Цикл не должен останавливаться: иначе все следующие записи ждали бы вечно
+                logger.error(f"Ошибка группового коммита: {e}")
+                results = [(future, None, e) for _, future in batch]
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            for _ in batch:
+                self.commit_queue.task_done()
+
+    async def commit_batch_operations(self, batch):
+        results = []
+        async with self.write_lock:
+            try:
+                await self.writer.execute("BEGIN")
+                for operation, future in batch:
+                    # Ошибка одной операции откатывает только её, а не всю пачку
+                    await self.writer.execute("SAVEPOINT operation")
+                    try:
+                        result = await operation(self.writer)
+                        await self.writer.execute("RELEASE operation")
+                        results.append((future, result, None))
+                    except Exception as e:
+                        await self.writer.execute("ROLLBACK TO operation")
+                        await self.writer.execute("RELEASE operation")
+                        results.append((future, None, e))
+                await self.writer.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка группового коммита: {e}")
+                await self.writer.rollback()
+                results = [(future, None, e) for _, future in batch]
+        return results
+
+    async def get_profile(self, user_id):
+        profile = self.profiles.get(user_id)
+        if profile is not MISSING:
+            return profile
+        version = self.profiles.version(user_id)
+        row = await self.fetchone(
+            "SELECT balance, earned, referral_id, referrals_direct, "
+            "(SELECT COUNT(*) FROM keys k WHERE k.user_id = u.user_id), "
+            "referrals_total, revenue_direct, revenue_total "
+            "FROM users u WHERE user_id = ?",
+            (user_id,)
+        )
+        profile = Profile(*row) if row else None
+        self.profiles.put(user_id, profile, version)
+        return profile
+
+    async def user_exists(self, user_id):
+        try:
+            return await self.get_profile(user_id) is not None
         except sqlite3.Error as e:
             logger.error(f"Ошибка в user_exists: {e}")
             return False
 
-    def add_user(self, user_id):
+    async def add_user(self, user_id):
         try:
-            with self.connection:
-                self.cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+            await self.execute(
+                "INSERT INTO users (user_id, created_at) VALUES (?, ?)",
+                (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            self.profiles.invalidate(user_id)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при добавлении пользователя: {e}")
 
-    def add_key(self, user_id, key, expires_at, server_id):
+    async def insert_key(self, connection, user_id, key, expires_at, server_id, paid):
+        # expires_at — Unix-время. Для коротких ключей (пробных) напоминание об истечении не нужно
+        reminded = int(expires_at <= time.time() + REMIND_BEFORE.total_seconds())
+        cursor = await connection.execute(
+            "INSERT INTO keys (user_id, key, expires_ts, server_id, reminded, paid) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, key, expires_at, server_id, reminded, int(paid))
+        )
+        return cursor.lastrowid, reminded
+
+    def key_added(self, key_id, reminded, user_id, key, expires_at, server_id):
+        # Обновление состояния в памяти — только после успешного коммита
+        self.allocator.add_key(server_id, expires_at)
+        self.profiles.invalidate(user_id)
+        for listener in self.key_listeners:
+            listener.key_added(key_id, user_id, key, expires_at, server_id)
+
+    async def add_key(self, user_id, key, expires_at, server_id, paid=False):
         try:
-            with self.connection:
-                self.cursor.execute("INSERT INTO keys (user_id, key, expires_at, server_id) VALUES (?, ?, ?, ?)", (user_id, key, expires_at, server_id))
+            key_id, reminded = await self.submit(
+                lambda connection: self.insert_key(connection, user_id, key, expires_at, server_id, paid)
+            )
+            self.key_added(key_id, reminded, user_id, key, expires_at, server_id)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при добавлении ключа: {e}")
 
-    def get_user_keys(self, user_id):
+    async def add_keys(self, items):
+        # Пачка ключей одной транзакцией: items — (user_id, key, expires_at, server_id, paid).
+        # Пользователи, которых ещё нет в базе, создаются: ключи увидят после /start
+        async def operation(connection):
+            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            await connection.executemany(
+                "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
+                [(user_id, created_at) for user_id in {item[0] for item in items}]
+            )
+            return [await self.insert_key(connection, *item) for item in items]
+
+        try:
+            inserted = await self.submit(operation)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при добавлении ключей: {e}")
+            return False
+        for (key_id, reminded), (user_id, key, expires_at, server_id, _) in zip(inserted, items):
+            self.key_added(key_id, reminded, user_id, key, expires_at, server_id)
+        return True
+
+    async def get_user_keys(self, user_id):
         try:
-            self.cursor.execute("SELECT key, expires_at FROM keys WHERE user_id = ?", (user_id,))
-            return self.cursor.fetchall()
+            return await self.fetchall(
+                "SELECT key, expires_ts, server_id FROM keys WHERE user_id = ? AND expires_ts IS NOT NULL ORDER BY expires_ts",
+                (user_id,)
+            )
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_user_keys: {e}")
             return []
 
-    def key_exists(self, user_id):
+    async def get_templates(self, server_ids):
+        # Недостающие шаблоны загружаются одним запросом на всю пачку
+        missing = {server_id for server_id in server_ids if server_id not in self.templates}
+        if missing:
+            placeholders = ", ".join("?" * len(missing))
+            rows = await self.fetchall(f"SELECT {TEMPLATE_COLUMNS} FROM servers WHERE id IN ({placeholders})", tuple(missing))
+            for row in rows:
+                self.templates[row[0]] = ServerTemplate(*row)
+        return self.templates
+
+    def invalidate_template(self, server_id):
+        self.templates.pop(server_id, None)
+        self.template_generation += 1
+
+    async def get_template(self, server_id):
+        try:
+            return (await self.get_templates((server_id,))).get(server_id)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_template: {e}")
+            return None
+
+    async def build_uris(self, rows):
+        # rows: (key, server_id, ...) — ссылки для «Моих ключей» и выгрузок; ключ без сервера остаётся как есть
+        try:
+            templates = await self.get_templates({row[1] for row in rows})
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в build_uris: {e}")
+            templates = {}
+        uris = []
+        for row in rows:
+            template = templates.get(row[1])
+            uris.append(template.uri(row[0]) if template else row[0])
+        return uris
+
+    async def get_active_keys(self, user_id, now):
+        try:
+            return await self.fetchall(
+                "SELECT key, server_id, expires_ts FROM keys WHERE user_id = ? AND expires_ts > ? ORDER BY expires_ts",
+                (user_id, now)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_active_keys: {e}")
+            return []
+
+    async def get_sub_token(self, user_id):
+        # Токен подписки создаётся при первом запросе и дальше не меняется: обычно хватает чтения,
+        # транзакция записи нужна только в первый раз
+        try:
+            row = await self.fetchone("SELECT sub_token FROM users WHERE user_id = ?", (user_id,))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_sub_token: {e}")
+            return None
+        if row is None:
+            return None
+        if row[0] is not None:
+            return row[0]
+
+        async def operation(connection):
+            async with connection.execute(
+                "UPDATE users SET sub_token = COALESCE(sub_token, ?) WHERE user_id = ? RETURNING sub_token",
+                (secrets.token_urlsafe(24), user_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+            return row[0] if row else None
+
+        try:
+            return await self.submit(operation)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_sub_token: {e}")
+            return None
+
+    async def get_user_by_sub_token(self, token):
+        try:
+            row = await self.fetchone("SELECT user_id FROM users WHERE sub_token = ?", (token,))
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_user_by_sub_token: {e}")
+            return None
+
+    async def key_exists(self, user_id):
         try:
-            self.cursor.execute("SELECT id FROM keys WHERE user_id = ?", (user_id,))
-            return self.cursor.fetchone() is not None
+            profile = await self.get_profile(user_id)
+            return profile is not None and profile.keys > 0
         except sqlite3.Error as e:
             logger.error(f"Ошибка в key_exists: {e}")
             return False
 
-    def add_server(self, ip, port, protocol):
+    async def add_server(self, ip, port, protocol, capacity=DEFAULT_CAPACITY):
         try:
-            with self.connection:
-                self.cursor.execute("INSERT INTO servers (ip, port, protocol) VALUES (?, ?, ?)", (ip, port, protocol))
+            server_id = await self.execute("INSERT INTO servers (ip, port, protocol, capacity) VALUES (?, ?, ?, ?)", (ip, port, protocol, capacity))
+            self.invalidate_template(server_id)
+            self.allocator.set_server(server_id, capacity)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при добавлении сервера: {e}")
 
-    def get_servers(self):
+    async def get_servers(self):
         try:
-            self.cursor.execute("SELECT id, ip, port, protocol FROM servers WHERE status = 'active'")
-            return self.cursor.fetchall()
+            return await self.fetchall("SELECT id, ip, port, protocol FROM servers WHERE status IN ('active', 'degraded')")
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_servers: {e}")
             return []
 
-    def get_server_by_id(self, server_id):
+    async def get_probe_targets(self):
+        # Отключённые админом серверы не проверяются и не возвращаются в работу автоматически
+        try:
+            return await self.fetchall("SELECT id, ip, port, status FROM servers WHERE status != 'inactive'")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_probe_targets: {e}")
+            return []
+
+    async def get_server_by_id(self, server_id):
         try:
-            self.cursor.execute("SELECT ip, port, protocol FROM servers WHERE id = ?", (server_id,))
-            return self.cursor.fetchone()
+            return await self.fetchone("SELECT ip, port, protocol FROM servers WHERE id = ?", (server_id,))
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_server_by_id: {e}")
             return None
 
-    def update_server_status(self, server_id, status):
+    async def update_server_status(self, server_id, status):
         try:
-            with self.connection:
-                self.cursor.execute("UPDATE servers SET status = ? WHERE id = ?", (status, server_id))
+            await self.execute("UPDATE servers SET status = ? WHERE id = ?", (status, server_id))
+            self.invalidate_template(server_id)
+            if status in SERVING_STATUSES:
+                await self.load_server(server_id)
+            else:
+                self.allocator.remove_server(server_id)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при обновлении статуса сервера: {e}")
 
-    def get_least_loaded_server(self):
+    async def update_server_settings(self, server_id, settings):
+        # settings: {колонка: значение} из SERVER_SETTINGS
         try:
-            servers = self.get_servers()
-            if not servers:
-                return None
+            unknown = set(settings) - set(SERVER_SETTINGS)
+            if unknown:
+                raise ValueError(f"Неизвестные параметры сервера: {', '.join(sorted(unknown))}")
+            assignments = ", ".join(f"{column} = ?" for column in settings)
+            await self.execute(f"UPDATE servers SET {assignments} WHERE id = ?", (*settings.values(), server_id))
+            self.invalidate_template(server_id)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при обновлении параметров сервера: {e}")
+            return False
+
+    async def set_health_status(self, server_id, status):
+        # Как update_server_status, но не трогает серверы, которые админ успел отключить
+        async def operation(connection):
+            cursor = await connection.execute(
+                "UPDATE servers SET status = ? WHERE id = ? AND status != 'inactive'", (status, server_id)
+            )
+            return cursor.rowcount
+
+        try:
+            if not await self.submit(operation):
+                return False
+            if status in SERVING_STATUSES:
+                await self.load_server(server_id)
+            else:
+                self.allocator.remove_server(server_id)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при обновлении статуса сервера: {e}")
+            return False
+
+    async def update_server_capacity(self, server_id, capacity):
+        try:
+            await self.execute("UPDATE servers SET capacity = ? WHERE id = ?", (capacity, server_id))
+            if server_id in self.allocator.capacity:
+                await self.load_server(server_id)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при обновлении ёмкости сервера: {e}")
+
+    async def load_server(self, server_id):
+        row = await self.fetchone("SELECT capacity FROM servers WHERE id = ? AND status IN ('active', 'degraded')", (server_id,))
+        if row:
+            self.allocator.set_server(server_id, row[0])
+
+    async def load_allocator(self):
+        # Полный пересчёт загрузки выполняется один раз при старте
+        try:
+            allocator = ServerAllocator()
+            rows = await self.fetchall(
+                "SELECT server_id, expires_ts / 60 AS bucket, COUNT(*) FROM keys "
+                "WHERE expires_ts > ? GROUP BY server_id, bucket",
+                (int(time.time()),)
+            )
+            for server_id, bucket, count in rows:
+                allocator.add_key(server_id, bucket * 60, count)
+            for server_id, capacity in await self.fetchall("SELECT id, capacity FROM servers WHERE status IN ('active', 'degraded')"):
+                allocator.set_server(server_id, capacity)
+            self.allocator = allocator
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при загрузке серверов: {e}")
+
+    async def get_least_loaded_server(self):
+        return self.allocator.pick()
+
+    async def get_pool_sizes(self):
+        try:
+            return dict(await self.fetchall("SELECT server_id, COUNT(*) FROM key_pool GROUP BY server_id"))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_pool_sizes: {e}")
+            return {}
+
+    async def add_pool_keys(self, server_id, keys):
+        try:
+            now = int(time.time())
+            await self.executemany(
+                "INSERT INTO key_pool (server_id, key, created_at) VALUES (?, ?, ?)",
+                [(server_id, key, now) for key in keys]
+            )
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при пополнении пула ключей: {e}")
+            return False
+
+    async def claim_pool_key(self, server_id):
+        # Удаление с RETURNING атомарно: один ключ из пула не достанется двум пользователям
+        async def operation(connection):
+            async with connection.execute(
+                "DELETE FROM key_pool WHERE id = (SELECT id FROM key_pool WHERE server_id = ? ORDER BY id LIMIT 1) "
+                "RETURNING key",
+                (server_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            return row[0] if row else None
+
+        try:
+            return await self.submit(operation)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при выдаче ключа из пула: {e}")
+            return None
 
-            server_load = {}
-            for server in servers:
-                server_id = server[0]
-                self.cursor.execute("SELECT COUNT(*) FROM keys WHERE server_id = ?", (server_id,))
-                load = self.cursor.fetchone()[0]
-                server_load[server_id] = load
+    async def get_expiring_keys(self, start, until):
+        try:
+            return await self.fetchall(
+                "SELECT id, user_id, key, expires_ts FROM keys "
+                "WHERE expires_ts > ? AND expires_ts <= ? AND reminded = 0 ORDER BY expires_ts",
+                (start, until)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_expiring_keys: {e}")
+            return []
+
+    async def mark_reminded(self, key_ids):
+        try:
+            placeholders = ", ".join("?" * len(key_ids))
+            await self.execute(f"UPDATE keys SET reminded = 1 WHERE id IN ({placeholders})", key_ids)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в mark_reminded: {e}")
 
-            least_loaded_server_id = min(server_load, key=server_load.get)
-            return least_loaded_server_id
+    async def get_stats(self, since):
+        # Все счётчики считаются в SQL одним запросом, строки в Python не загружаются
+        try:
+            now = int(time.time())
+            totals = await self.fetchone(
+                "SELECT "
+                "(SELECT COUNT(*) FROM users), "
+                "(SELECT COUNT(*) FROM keys WHERE expires_ts > ?), "
+                "(SELECT COUNT(*) FROM keys WHERE expires_ts <= ?), "
+                "(SELECT COUNT(*) FROM keys WHERE paid = 1), "
+                "(SELECT COUNT(*) FROM keys WHERE paid = 0), "
+                "(SELECT COALESCE(SUM(earned), 0) FROM users), "
+                "(SELECT COALESCE(SUM(earned_delta), 0) FROM ledger WHERE kind = 'referral_bonus'), "
+                "(SELECT COALESCE(SUM(balance_delta), 0) FROM ledger WHERE kind = 'withdrawal')",
+                (now, now)
+            )
+            signups = await self.fetchall(
+                "SELECT substr(created_at, 1, 10) AS day, COUNT(*) FROM users "
+                "WHERE created_at >= ? GROUP BY day ORDER BY day",
+                (since,)
+            )
+            users, active_keys, expired_keys, paid_keys, trial_keys, earned_total, bonus_total, withdrawn_total = totals
+            return {
+                "users": users,
+                "active_keys": active_keys,
+                "expired_keys": expired_keys,
+                "paid_keys": paid_keys,
+                "trial_keys": trial_keys,
+                "earned_total": earned_total,
+                "bonus_total": bonus_total,
+                "withdrawn_total": withdrawn_total,
+                "signups": signups,
+            }
         except sqlite3.Error as e:
-            logger.error(f"Ошибка в get_least_loaded_server: {e}")
+            logger.error(f"Ошибка в get_stats: {e}")
             return None
 
-    def get_all_keys(self):
+    async def add_pending_payment(self, payment_id, user_id, tariff, amount, days, now):
+        try:
+            await self.execute(
+                "INSERT INTO pending_payments (payment_id, user_id, tariff, amount, days, next_check_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (payment_id, user_id, tariff, amount, days, now, now)
+            )
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при сохранении платежа: {e}")
+            return False
+
+    async def get_due_payments(self, now, limit):
         try:
-            self.cursor.execute("SELECT user_id, key, expires_at FROM keys")
-            return self.cursor.fetchall()
+            return await self.fetchall(
+                "SELECT payment_id, user_id, tariff, amount, days, attempts, created_at FROM pending_payments "
+                "WHERE status = 'pending' AND next_check_at <= ? ORDER BY next_check_at LIMIT ?",
+                (now, limit)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_due_payments: {e}")
+            return []
+
+    async def reschedule_payments(self, rows):
+        # rows: (next_check_at, payment_id) — одна транзакция на всю пачку
+        try:
+            await self.executemany(
+                "UPDATE pending_payments SET attempts = attempts + 1, next_check_at = ? "
+                "WHERE payment_id = ? AND status = 'pending'",
+                rows
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при переносе проверки платежей: {e}")
+
+    async def close_payments(self, payment_ids, status):
+        try:
+            await self.executemany(
+                "UPDATE pending_payments SET status = ? WHERE payment_id = ? AND status = 'pending'",
+                [(status, payment_id) for payment_id in payment_ids]
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при закрытии платежей: {e}")
+
+    async def payment_pending(self, payment_id):
+        try:
+            row = await self.fetchone("SELECT 1 FROM pending_payments WHERE payment_id = ? AND status = 'pending'", (payment_id,))
+            return row is not None
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в payment_pending: {e}")
+            return False
+
+    async def complete_payment(self, payment_id, user_id, key, expires_at, server_id, referral_id, bonus):
+        # Ключ, бонус рефереру и статус платежа записываются одной транзакцией.
+        # Повторный вызов для того же платежа ничего не меняет и возвращает False
+        async def operation(connection):
+            async with connection.execute(
+                "UPDATE pending_payments SET status = 'completed', key = ? "
+                "WHERE payment_id = ? AND status = 'pending' RETURNING amount",
+                (key, payment_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            inserted = await self.insert_key(connection, user_id, key, expires_at, server_id, True)
+            if referral_id and bonus:
+                await self.insert_ledger(connection, referral_id, "referral_bonus", 0, bonus, payment_id)
+            ancestors = await self.add_referral_revenue(connection, referral_id, row[0] or 0) if referral_id else []
+            return inserted, ancestors
+
+        result = await self.submit(operation)
+        if result is None:
+            return False
+        (key_id, reminded), ancestors = result
+        self.key_added(key_id, reminded, user_id, key, expires_at, server_id)
+        if ancestors:
+            self.profiles.invalidate(*ancestors)
+        return True
+
+    async def count_users(self):
+        try:
+            result = await self.fetchone("SELECT COUNT(*) FROM users")
+            return result[0]
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в count_users: {e}")
+            return 0
+
+    async def get_user_ids_after(self, last_user_id, limit):
+        # Постраничная выборка по ключу: каждая страница — поиск по индексу, без OFFSET
+        try:
+            rows = await self.fetchall(
+                "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_user_id, limit)
+            )
+            return [row[0] for row in rows]
         except sqlite3.Error as e:
-            logger.error(f"Ошибка в get_all_keys: {e}")
+            logger.error(f"Ошибка в get_user_ids_after: {e}")
             return []
 
-    def get_all_users(self):
+    async def create_broadcast(self, text, admin_id, total):
         try:
-            self.cursor.execute("SELECT user_id FROM users")
-            return self.cursor.fetchall()
+            return await self.execute("INSERT INTO broadcasts (text, admin_id, total) VALUES (?, ?, ?)", (text, admin_id, total))
         except sqlite3.Error as e:
-            logger.error(f"Ошибка в get_all_users: {e}")
+            logger.error(f"Ошибка при создании рассылки: {e}")
+            return None
+
+    async def update_broadcast(self, broadcast_id, last_user_id, sent, blocked, failed, status="running"):
+        try:
+            await self.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent = ?, blocked = ?, failed = ?, status = ? WHERE id = ?",
+                (last_user_id, sent, blocked, failed, status, broadcast_id)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при сохранении прогресса рассылки: {e}")
+
+    async def get_unfinished_broadcasts(self):
+        try:
+            return await self.fetchall(
+                "SELECT id, text, admin_id, total, last_user_id, sent, blocked, failed FROM broadcasts WHERE status = 'running'"
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_unfinished_broadcasts: {e}")
             return []
 
-    def block_user(self, user_id):
+    async def block_user(self, user_id):
+        await self.block_users([user_id])
+
+    async def block_users(self, user_ids):
+        # Удаляет ключи пользователей одной транзакцией. Возвращает {user_id: число удалённых ключей}
+        # или None при ошибке
+        placeholders = ", ".join("?" * len(user_ids))
+
+        async def operation(connection):
+            async with connection.execute(
+                f"SELECT id, user_id, server_id, expires_ts FROM keys WHERE user_id IN ({placeholders})", tuple(user_ids)
+            ) as cursor:
+                keys = await cursor.fetchall()
+            await connection.execute(f"DELETE FROM keys WHERE user_id IN ({placeholders})", tuple(user_ids))
+            return keys
+
         try:
-            with self.connection:
-                self.cursor.execute("DELETE FROM keys WHERE user_id = ?", (user_id,))
+            keys = await self.submit(operation)
         except sqlite3.Error as e:
-            logger.error(f"Ошибка при блокировке пользователя: {e}")
+            logger.error(f"Ошибка при блокировке пользователей: {e}")
+            return None
+        self.profiles.invalidate(*user_ids)
+        removed = {user_id: [] for user_id in user_ids}
+        for key_id, user_id, server_id, expires_ts in keys:
+            if expires_ts is not None:
+                self.allocator.remove_key(server_id, expires_ts)
+            removed[user_id].append(key_id)
+        for user_id, key_ids in removed.items():
+            for listener in self.key_listeners:
+                listener.keys_removed(user_id, key_ids)
+        return {user_id: len(key_ids) for user_id, key_ids in removed.items()}
+
+    async def get_ancestors(self, connection, user_id):
+        async with connection.execute(f"{ANCESTORS} SELECT id FROM up", (user_id,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def add_referral_revenue(self, connection, referral_id, amount):
+        # Платёж реферала увеличивает выручку его реферера и всех рефереров выше по цепочке
+        ancestors = await self.get_ancestors(connection, referral_id)
+        await connection.execute("UPDATE users SET revenue_direct = revenue_direct + ? WHERE user_id = ?", (amount, referral_id))
+        await connection.execute(
+            f"{ANCESTORS} UPDATE users SET revenue_total = revenue_total + ? WHERE user_id IN (SELECT id FROM up)",
+            (referral_id, amount)
+        )
+        return ancestors
+
+    async def add_referral(self, user_id, referral_id):
+        # Реферер назначается один раз и только существующий; приглашение из собственной сети
+        # (которое замкнуло бы цепочку) отклоняется. Возвращает True, если реферер назначен
+        async def operation(connection):
+            ancestors = await self.get_ancestors(connection, referral_id)
+            if user_id in ancestors:
+                return None
+            cursor = await connection.execute(
+                "UPDATE users SET referral_id = ? WHERE user_id = ? AND referral_id IS NULL "
+                "AND EXISTS (SELECT 1 FROM users WHERE user_id = ?)",
+                (referral_id, user_id, referral_id)
+            )
+            if cursor.rowcount != 1:
+                return None
+            # Вместе с пользователем к цепочке присоединяется и его собственная сеть
+            async with connection.execute(
+                "SELECT referrals_total, revenue_total, "
+                "(SELECT COALESCE(SUM(amount), 0) FROM pending_payments WHERE user_id = ? AND status = 'completed') "
+                "FROM users WHERE user_id = ?",
+                (user_id, user_id)
+            ) as cursor:
+                referrals, revenue, paid = await cursor.fetchone()
+            await connection.execute(
+                "UPDATE users SET referrals_direct = referrals_direct + 1, revenue_direct = revenue_direct + ? WHERE user_id = ?",
+                (paid, referral_id)
+            )
+            await connection.execute(
+                f"{ANCESTORS} UPDATE users SET referrals_total = referrals_total + ?, revenue_total = revenue_total + ? "
+                "WHERE user_id IN (SELECT id FROM up)",
+                (referral_id, referrals + 1, revenue + paid)
+            )
+            return ancestors
 
-    def add_referral(self, user_id, referral_id):
         try:
-            with self.connection:
-                self.cursor.execute("UPDATE users SET referral_id = ? WHERE user_id = ?", (referral_id, user_id))
+            ancestors = await self.submit(operation)
+            if ancestors is None:
+                return False
+            self.profiles.invalidate(user_id, *ancestors)
+            return True
         except sqlite3.Error as e:
             logger.error(f"Ошибка при добавлении реферала: {e}")
+            return False
 
-    def get_referrals(self, user_id):
+    async def get_downline_levels(self, user_id, max_depth=REFERRAL_MAX_DEPTH):
+        # Размер и выручка реферальной сети по уровням: 1 — приглашённые напрямую
         try:
-            self.cursor.execute("SELECT user_id FROM users WHERE referral_id = ?", (user_id,))
-            return self.cursor.fetchall()
+            return await self.fetchall(
+                "WITH RECURSIVE down(id, depth) AS ("
+                "SELECT user_id, 1 FROM users WHERE referral_id = ? "
+                "UNION SELECT u.user_id, down.depth + 1 FROM users u JOIN down ON u.referral_id = down.id WHERE down.depth < ?) "
+                "SELECT depth, COUNT(*), COALESCE(SUM("
+                "(SELECT SUM(amount) FROM pending_payments p WHERE p.user_id = down.id AND p.status = 'completed')), 0) "
+                "FROM down GROUP BY depth ORDER BY depth",
+                (user_id, max_depth)
+            )
         except sqlite3.Error as e:
-            logger.error(f"Ошибка в get_referrals: {e}")
+            logger.error(f"Ошибка в get_downline_levels: {e}")
             return []
 
-    def add_earned(self, user_id, amount):
+    async def get_referral_leaders(self, limit):
+        # Частичный индекс idx_users_referrals_total содержит только пользователей с рефералами
         try:
-            with self.connection:
-                self.cursor.execute("UPDATE users SET earned = earned + ? WHERE user_id = ?", (amount, user_id))
+            return await self.fetchall(
+                "SELECT user_id, referrals_direct, referrals_total, revenue_direct, revenue_total FROM users "
+                "WHERE referrals_total > 0 ORDER BY referrals_total DESC, user_id LIMIT ?",
+                (limit,)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_referral_leaders: {e}")
+            return []
+
+    async def insert_ledger(self, connection, user_id, kind, balance_delta, earned_delta, ref=None):
+        # Запись в журнал и изменение остатков всегда идут в одной транзакции
+        await connection.execute(
+            "INSERT INTO ledger (user_id, kind, balance_delta, earned_delta, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, kind, balance_delta, earned_delta, ref, int(time.time()))
+        )
+        await connection.execute(
+            "UPDATE users SET balance = balance + ?, earned = earned + ? WHERE user_id = ?",
+            (balance_delta, earned_delta, user_id)
+        )
+
+    async def post_ledger(self, user_id, kind, balance_delta, earned_delta, ref=None):
+        async def operation(connection):
+            await self.insert_ledger(connection, user_id, kind, balance_delta, earned_delta, ref)
+
+        await self.submit(operation)
+        self.profiles.invalidate(user_id)
+
+    async def add_earned(self, user_id, amount, ref=None):
+        try:
+            await self.post_ledger(user_id, "referral_bonus", 0, amount, ref)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при добавлении заработка: {e}")
 
-    def get_earned(self, user_id):
+    async def withdraw_earned(self, user_id):
+        # Перевод заработанного на баланс — одна транзакция: чтение остатка, перевод и запись в журнал.
+        # Операции группового коммита выполняются по очереди, поэтому двойное нажатие не спишет дважды
+        async def operation(connection):
+            async with connection.execute("SELECT earned FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            earned = row[0] if row else 0
+            if earned <= 0:
+                return 0
+            await self.insert_ledger(connection, user_id, "withdrawal", earned, -earned)
+            return earned
+
+        try:
+            earned = await self.submit(operation)
+            self.profiles.invalidate(user_id)
+            return earned
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при выводе средств: {e}")
+            return 0
+
+    async def get_earned(self, user_id):
         try:
-            self.cursor.execute("SELECT earned FROM users WHERE user_id = ?", (user_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else 0
+            profile = await self.get_profile(user_id)
+            return profile.earned if profile else 0
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_earned: {e}")
             return 0
 
-    def add_balance(self, user_id, amount):
+    async def add_balance(self, user_id, amount, ref=None):
         try:
-            with self.connection:
-                self.cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+            await self.post_ledger(user_id, "top_up", amount, 0, ref)
         except sqlite3.Error as e:
             logger.error(f"Ошибка при пополнении баланса: {e}")
 
-    def get_balance(self, user_id):
+    async def get_balance(self, user_id):
         try:
-            self.cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else 0
+            profile = await self.get_profile(user_id)
+            return profile.balance if profile else 0
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_balance: {e}")
             return 0
 
-    def get_referral_id(self, user_id):
+    async def get_referral_id(self, user_id):
         try:
-            self.cursor.execute("SELECT referral_id FROM users WHERE user_id = ?", (user_id,))
-            result = self.cursor.fetchone()
-            return result[0] if result else None
+            profile = await self.get_profile(user_id)
+            return profile.referral_id if profile else None
         except sqlite3.Error as e:
             logger.error(f"Ошибка в get_referral_id: {e}")
             return None
 
-    def update_price(self, tariff, amount):
+    async def seed_tariffs(self, tariffs):
+        # Изменённые админом цены не перезаписываются, дополняются только пустые поля
+        try:
+            await self.executemany(
+                "INSERT INTO prices (tariff, amount, days, title) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (tariff) DO UPDATE SET amount = COALESCE(amount, excluded.amount), "
+                "days = COALESCE(days, excluded.days), title = COALESCE(title, excluded.title)",
+                tariffs
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при заполнении тарифов: {e}")
+
+    async def get_tariffs(self):
         try:
-            with self.connection:
-                self.cursor.execute("INSERT OR REPLACE INTO prices (tariff, amount) VALUES (?, ?)", (tariff, amount))
+            return await self.fetchall(
+                "SELECT tariff, amount, days, title FROM prices WHERE days IS NOT NULL ORDER BY days"
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка в get_tariffs: {e}")
+            return []
+
+    async def update_price(self, tariff, amount):
+        try:
+            await self.execute(
+                "INSERT INTO prices (tariff, amount) VALUES (?, ?) ON CONFLICT (tariff) DO UPDATE SET amount = excluded.amount",
+                (tariff, amount)
+            )
         except sqlite3.Error as e:
             logger.error(f"Ошибка при обновлении цены: {e}")
 
-    def get_price(self, tariff):
+    async def get_price(self, tariff):
         try:
-            self.cursor.execute("SELECT amount FROM prices WHERE tariff = ?", (tariff,))
-            result = self.cursor.fetchone()
+            result = await self.fetchone("SELECT amount FROM prices WHERE tariff = ?", (tariff,))
             return result[0] if result else None
         except sqlite3.Error as e:
             logger.error(f"Ошибка при получении цены: {e}")
@@ -0,0 +1,85 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+REMIND_BEFORE = timedelta(days=1)  # за сколько до истечения предупреждать пользователя
+WINDOW = timedelta(hours=6)  # насколько далеко вперёд подгружаются напоминания из базы
+
+class ExpiryScheduler:
+    def __init__(self, db, bot):
+        self.db = db
+        self.bot = bot
+        self.heap = []  # (expires_ts, key_id)
+        self.scheduled = {}  # key_id -> (user_id, key) для ключей в куче
+        self.loaded_until = None  # граница подгруженного окна
+        self.next_load = 0
+        self.wakeup = asyncio.Event()
+
+    def key_added(self, key_id, user_id, key, expires_ts, server_id):
+        # Для коротких ключей напоминание не нужно (в базе они сразу отмечены reminded),
+        # ключи дальше окна подгрузятся из базы позже
+        if expires_ts <= time.time() + REMIND_BEFORE.total_seconds():
+            return
+        if self.loaded_until is not None and expires_ts <= self.loaded_until:
+            self.schedule(key_id, user_id, key, expires_ts)
+            self.wakeup.set()
+
+    def keys_removed(self, user_id, key_ids):
+        for key_id in key_ids:
+            self.scheduled.pop(key_id, None)
+
+    def schedule(self, key_id, user_id, key, expires_ts):
+        if key_id not in self.scheduled:
+            self.scheduled[key_id] = (user_id, key)
+            heapq.heappush(self.heap, (expires_ts, key_id))
+
+    async def load_window(self):
+        now = int(time.time())
+        until = now + int((REMIND_BEFORE + WINDOW).total_seconds())
+        rows = await self.db.get_expiring_keys(now, until)
+        for key_id, user_id, key, expires_ts in rows:
+            self.schedule(key_id, user_id, key, expires_ts)
+        self.loaded_until = until
+        self.next_load = now + WINDOW.total_seconds()
+
+    async def send_due(self):
+        horizon = time.time() + REMIND_BEFORE.total_seconds()
+        sent = []
+        while self.heap and self.heap[0][0] <= horizon:
+            _, key_id = heapq.heappop(self.heap)
+            entry = self.scheduled.pop(key_id, None)
+            if entry is None:
+                continue  # ключ удалён
+            user_id, key = entry
+            try:
+                await self.bot.send_message(user_id, f"Ваш ключ истекает через 1 день:\n\n`{key}`\n\nПродлите его, чтобы продолжить использование.", parse_mode="Markdown")
+            except Exception as e:
+                logger.warning(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
+            sent.append(key_id)
+        if sent:
+            await self.db.mark_reminded(sent)
+
+    def seconds_until_next(self):
+        wake_at = self.next_load
+        if self.heap:
+            wake_at = min(wake_at, self.heap[0][0] - REMIND_BEFORE.total_seconds())
+        return max(wake_at - time.time(), 0)
+
+    async def run(self):
+        while True:
+            try:
+                if time.time() >= self.next_load:
+                    await self.load_window()
+                await self.send_due()
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике напоминаний: {e}")
+                await asyncio.sleep(60)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.seconds_until_next())
+            except asyncio.TimeoutError:
+                pass
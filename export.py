@@ -0,0 +1,94 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram.types import FSInputFile
+
+from database import EXPORT_QUERIES
+from vless_generator import format_expiration
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "jsonl")
+MAX_UPLOAD = 50 * 1024 * 1024  # предел размера файла, который бот может отправить
+
+class DataExporter:
+    # Выгрузка таблиц админу. Строки идут из курсора во временный файл по мере чтения,
+    # поэтому память не зависит от размера базы; все таблицы берутся из одного снимка
+    def __init__(self, db, bot):
+        self.db = db
+        self.bot = bot
+
+    def start(self, tables, fmt, admin_id):
+        asyncio.create_task(self.run(tables, fmt, admin_id))
+
+    async def run(self, tables, fmt, admin_id):
+        started = time.monotonic()
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        paths = []
+        try:
+            async with self.db.snapshot() as connection:
+                for table in tables:
+                    # Уникальный временный файл: выгрузки, начатые в одну секунду, не перезаписывают друг друга
+                    fd, path = tempfile.mkstemp(prefix=f"{table}_{stamp}_", suffix=f".{fmt}")
+                    os.close(fd)
+                    paths.append((path, f"{table}_{stamp}.{fmt}"))
+                    count = await self.write(connection, table, fmt, path)
+                    logger.info(f"Выгрузка {table}: {count} строк")
+            for path, name in paths:
+                if os.path.getsize(path) > MAX_UPLOAD:
+                    await self.bot.send_message(admin_id, f"⚠️ Файл {name} больше 50 МБ и не может быть отправлен.")
+                    continue
+                await self.bot.send_document(admin_id, FSInputFile(path, filename=name))
+            await self.bot.send_message(admin_id, f"✅ Выгрузка готова за {time.monotonic() - started:.1f} сек.")
+        except Exception as e:
+            logger.error(f"Ошибка при выгрузке {', '.join(tables)}: {e}")
+            await self.bot.send_message(admin_id, "Произошла ошибка при выгрузке.")
+        finally:
+            for path, _ in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    async def write(self, connection, table, fmt, path):
+        batches = self.db.export_rows(connection, table)
+        columns = await anext(batches)
+        if table == "keys":
+            columns = [*columns, "expires", "link"]
+        count = 0
+        # BOM — чтобы Excel открыл CSV в UTF-8
+        with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as file:
+            writer = csv.writer(file) if fmt == "csv" else None
+            if writer:
+                writer.writerow(columns)
+            async for rows in batches:
+                if table == "keys":
+                    rows = await self.with_links(rows)
+                if writer:
+                    writer.writerows(rows)
+                else:
+                    file.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+                count += len(rows)
+        return count
+
+    async def with_links(self, rows):
+        # Ссылки собираются по шаблонам серверов, которые кэшируются в Database
+        uris = await self.db.build_uris([(row[2], row[3]) for row in rows])
+        return [(*row, format_expiration(row[4]) if row[4] else None, uri) for row, uri in zip(rows, uris)]
+
+def parse_export_args(args):
+    # export [users|keys|servers|all] [csv|jsonl]
+    tables = list(EXPORT_QUERIES)
+    fmt = "csv"
+    for arg in args:
+        if arg in EXPORT_QUERIES:
+            tables = [arg]
+        elif arg in FORMATS:
+            fmt = arg
+        elif arg != "all":
+            return None
+    return tables, fmt
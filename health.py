@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+from metrics import httpx_hooks
+
+logger = logging.getLogger(__name__)
+
+class NodeHealth:
+    def __init__(self, status):
+        self.status = status
+        self.latency = None  # сглаженная задержка ответа /health, секунд
+        self.error_rate = 0.0  # сглаженная доля неудачных проверок
+        self.failures = 0  # неудачных проверок подряд
+        self.successes = 0  # удачных проверок подряд
+        self.checked_at = None
+
+class HealthMonitor:
+    # Статус меняется с гистерезисом: узел выводится из работы после нескольких неудач подряд
+    # и возвращается после нескольких успехов, чтобы единичные сбои не дёргали распределение ключей
+    def __init__(self, db, concurrency=20, interval=15, timeout=3, alpha=0.3,
+                 fail_after=3, recover_after=2, slow=0.5, latency_weight=0.2):
+        self.db = db
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(timeout), event_hooks=httpx_hooks("health"))
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        self.alpha = alpha
+        self.fail_after = fail_after
+        self.recover_after = recover_after
+        self.slow = slow  # выше этой задержки узел считается деградировавшим
+        self.latency_weight = latency_weight  # надбавка к приоритету за каждые slow секунд задержки
+        self.nodes = {}  # server_id -> NodeHealth
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def probe(self, ip, port):
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                response = await self.client.get(f"http://{ip}:{port}/health")
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            return ok, time.monotonic() - started
+
+    def record(self, node, ok, latency):
+        node.checked_at = time.time()
+        node.error_rate = self.alpha * (not ok) + (1 - self.alpha) * node.error_rate
+        if ok:
+            node.latency = latency if node.latency is None else self.alpha * latency + (1 - self.alpha) * node.latency
+            node.successes += 1
+            node.failures = 0
+        else:
+            node.failures += 1
+            node.successes = 0
+
+    def next_status(self, node):
+        if node.status == "down":
+            if node.successes < self.recover_after:
+                return "down"
+        elif node.failures >= self.fail_after:
+            return "down"
+        if node.latency is None:
+            return node.status
+        # Порог выхода из degraded ниже порога входа, чтобы статус не колебался у границы
+        if node.status == "degraded":
+            return "degraded" if node.latency > self.slow * 0.7 else "active"
+        return "degraded" if node.latency > self.slow else "active"
+
+    def penalty(self, node):
+        latency = node.latency or 0
+        return node.error_rate + self.latency_weight * latency / self.slow
+
+    async def check(self, server_id, ip, port, status):
+        node = self.nodes.get(server_id)
+        if node is None:
+            node = self.nodes[server_id] = NodeHealth(status)
+        ok, latency = await self.probe(ip, port)
+        self.record(node, ok, latency)
+        new_status = self.next_status(node)
+        if new_status != node.status:
+            if await self.db.set_health_status(server_id, new_status):
+                logger.warning(f"Сервер {server_id} ({ip}): {node.status} -> {new_status}")
+                node.status = new_status
+        self.db.allocator.set_penalty(server_id, self.penalty(node))
+
+    async def check_all(self):
+        targets = await self.db.get_probe_targets()
+        probed = {server_id for server_id, *_ in targets}
+        # Серверы, отключённые админом, перестают отслеживаться
+        for server_id in set(self.nodes) - probed:
+            del self.nodes[server_id]
+        await asyncio.gather(*(self.check(*target) for target in targets))
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Ошибка при проверке серверов: {e}")
+            await asyncio.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+def format_health(monitor):
+    if not monitor.nodes:
+        return "Нет данных о состоянии серверов."
+    lines = []
+    for server_id, node in sorted(monitor.nodes.items()):
+        latency = f"{node.latency * 1000:.0f} мс" if node.latency is not None else "—"
+        lines.append(f"#{server_id}: {node.status}, задержка {latency}, ошибки {node.error_rate:.0%}")
+    return "\n".join(lines)
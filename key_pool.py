@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import math
+import time
+
+from vless_generator import generate_key
+
+logger = logging.getLogger(__name__)
+
+class KeyPool:
+    # Ключи заранее регистрируются на узлах, чтобы выдача не ждала ответа узла:
+    # пользователю достаётся ключ из пула, а пул пополняется в фоне пачками
+    def __init__(self, db, nodes, min_size=20, max_size=1000, lead_time=120, interval=5, batch=100, alpha=0.3):
+        self.db = db
+        self.nodes = nodes
+        self.min_size = min_size
+        self.max_size = max_size
+        self.lead_time = lead_time  # на сколько секунд выдачи должно хватать пула
+        self.interval = interval
+        self.batch = batch  # ключей в одном запросе к узлу
+        self.alpha = alpha  # вес последнего интервала в скользящем среднем
+        self.sizes = {}  # server_id -> ключей в пуле
+        self.claims = {}  # server_id -> выдано из пула с прошлого пересчёта
+        self.rates = {}  # server_id -> сглаженная скорость выдачи, ключей в секунду
+        self.updated = time.monotonic()
+        self.refilling = set()
+        self.wakeup = asyncio.Event()
+
+    def target(self, server_id):
+        wanted = math.ceil(self.rates.get(server_id, 0) * self.lead_time)
+        return min(max(wanted, self.min_size), self.max_size)
+
+    async def claim(self, server_id):
+        self.claims[server_id] = self.claims.get(server_id, 0) + 1
+        if not self.sizes.get(server_id):
+            self.wakeup.set()
+            return None
+        key = await self.db.claim_pool_key(server_id)
+        if key is None:
+            self.sizes[server_id] = 0
+        else:
+            self.sizes[server_id] -= 1
+        # Ниже половины целевого размера — пополняем, не дожидаясь очередного интервала
+        if self.sizes[server_id] < self.target(server_id) // 2:
+            self.wakeup.set()
+        return key
+
+    async def release(self, server_id, key):
+        # Ключ уже зарегистрирован на узле, но не понадобился: возвращаем его в пул, а не теряем
+        if await self.db.add_pool_keys(server_id, [key]):
+            self.sizes[server_id] = self.sizes.get(server_id, 0) + 1
+
+    def update_rates(self):
+        now = time.monotonic()
+        elapsed = max(now - self.updated, 1e-9)
+        self.updated = now
+        for server_id in set(self.rates) | set(self.claims):
+            rate = self.claims.get(server_id, 0) / elapsed
+            self.rates[server_id] = self.alpha * rate + (1 - self.alpha) * self.rates.get(server_id, rate)
+        self.claims = {}
+
+    async def refill(self, server_id):
+        template = await self.db.get_template(server_id)
+        if template is None:
+            return
+        missing = self.target(server_id) - self.sizes.get(server_id, 0)
+        while missing > 0:
+            keys = [generate_key() for _ in range(min(missing, self.batch))]
+            if not await self.nodes.add_users(template.ip, template.port, keys):
+                logger.warning(f"Не удалось пополнить пул ключей сервера {server_id}")
+                return
+            if not await self.db.add_pool_keys(server_id, keys):
+                return
+            self.sizes[server_id] = self.sizes.get(server_id, 0) + len(keys)
+            missing -= len(keys)
+
+    async def replenish(self):
+        # Скорость пересчитывается раз в интервал: досрочные пробуждения её не искажают
+        if time.monotonic() - self.updated >= self.interval:
+            self.update_rates()
+        tasks = []
+        for server_id in list(self.db.allocator.capacity):
+            if server_id in self.refilling or self.sizes.get(server_id, 0) >= self.target(server_id) // 2:
+                continue
+            self.refilling.add(server_id)
+            tasks.append(self.refill_server(server_id))
+        await asyncio.gather(*tasks)
+
+    async def refill_server(self, server_id):
+        try:
+            await self.refill(server_id)
+        except Exception as e:
+            logger.error(f"Ошибка при пополнении пула ключей сервера {server_id}: {e}")
+        finally:
+            self.refilling.discard(server_id)
+
+    async def run(self):
+        self.sizes = await self.db.get_pool_sizes()
+        while True:
+            try:
+                await self.replenish()
+            except Exception as e:
+                logger.error(f"Ошибка в пополнении пула ключей: {e}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,174 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from aiogram import BaseMiddleware
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Кто и в каком обработчике сейчас выполняется: проставляется middleware и попадает в каждую запись
+current_user = contextvars.ContextVar("current_user", default=None)
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+class ContextFilter(logging.Filter):
+    # Должен работать в потоке, который пишет в лог: в потоке записи контекста обработчика уже нет
+    def filter(self, record):
+        record.user_id = current_user.get()
+        record.handler = current_handler.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    # Повторяющиеся предупреждения и ошибки из одного места кода пропускаются не чаще burst раз за period
+    # секунд, остальные отбрасываются до постановки в очередь. Сообщения собираются f-строками и
+    # различаются, поэтому повтором считается запись с того же места (файл и строка), а не тот же текст.
+    def __init__(self, burst=5, period=60, level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.windows = {}  # (pathname, lineno) -> [начало окна, пропущено, подавлено]
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                skipped = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if skipped:
+                    record.msg = f"{record.msg} (подавлено повторов за {self.period} сек.: {skipped})"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Очередь ограничена: если поток записи не успевает (диск медленный, поток ошибок),
+    # записи отбрасываются, а не копятся в памяти и не блокируют цикл событий
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # В отличие от стандартного prepare, трассировка остаётся отдельным полем (exc_text),
+        # чтобы текстовый и JSON-форматы оформили её сами
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.message = record.msg
+        record.args = None
+        record.exc_info = None
+        return record
+
+class ContextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        context = " ".join(f"{name}={value}" for name in ("user_id", "handler")
+                           if (value := getattr(record, name, None)) is not None)
+        return f"{text} [{context}]" if context else text
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name in ("user_id", "handler"):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogContext(BaseMiddleware):
+    # Внутренний middleware: пользователь и имя обработчика для всех записей, сделанных при обработке
+    def __init__(self, label=None):
+        self.label = label  # label(event, data) -> имя обработчика или None, как в HandlerMetrics
+
+    async def __call__(self, handler, event, data):
+        name = self.label(event, data) if self.label else None
+        if name is None:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object else "unknown"
+        user = data.get("event_from_user")
+        user_token = current_user.set(user.id if user else None)
+        handler_token = current_handler.set(name)
+        try:
+            return await handler(event, data)
+        finally:
+            current_handler.reset(handler_token)
+            current_user.reset(user_token)
+
+class LogPipeline:
+    def __init__(self, handler, listener, sampling):
+        self.handler = handler
+        self.listener = listener
+        self.sampling = sampling
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    @property
+    def suppressed(self):
+        return self.sampling.suppressed
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+def setup_logging(path="bot.log", level=logging.INFO, json_format=False, max_bytes=10 * 1024 * 1024,
+                  backups=5, rotate_when=None, queue_size=10000, sample_burst=5, sample_period=60):
+    # Обработчики только ставят запись в очередь; форматирование и запись в файл и консоль — в отдельном потоке.
+    # rotate_when (например, "midnight") включает ротацию по времени вместо ротации по размеру.
+    if rotate_when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when, backupCount=backups, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    stream_handler = logging.StreamHandler(sys.stderr)
+    formatter = JsonFormatter() if json_format else ContextFormatter(TEXT_FORMAT)
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+
+    sampling = SamplingFilter(sample_burst, sample_period)
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(sampling)
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, file_handler, stream_handler)
+    listener.start()
+    pipeline = LogPipeline(handler, listener, sampling)
+    # Дописываем очередь при выходе из процесса
+    atexit.register(pipeline.stop)
+    return pipeline
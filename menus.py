@@ -0,0 +1,93 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from callback_router import callback_data
+
+# Клавиатуры и тексты не зависят от пользователя: строятся один раз при импорте
+
+# Главное меню
+MAIN_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="🆓 Бесплатный VPN", callback_data="get_key"),
+        InlineKeyboardButton(text="💳 Купить/Продлить VPN", callback_data="buy_vpn")
+    ],
+    [
+        InlineKeyboardButton(text="🔑 Мои ключи", callback_data="my_keys"),
+        InlineKeyboardButton(text="👥 Реферальная программа", callback_data="referral")
+    ],
+    [
+        InlineKeyboardButton(text="📚 Инструкция", callback_data="instruction")
+    ]
+])
+
+# Меню инструкций
+INSTRUCTION_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="Android", callback_data=callback_data("instruction", "android")),
+        InlineKeyboardButton(text="iOS", callback_data=callback_data("instruction", "ios"))
+    ],
+    [
+        InlineKeyboardButton(text="MacOS", callback_data=callback_data("instruction", "macos")),
+        InlineKeyboardButton(text="Windows", callback_data=callback_data("instruction", "windows"))
+    ],
+    [
+        InlineKeyboardButton(text="TV", callback_data=callback_data("instruction", "tv"))
+    ],
+    [
+        InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
+    ]
+])
+
+# Меню реферальной программы
+REFERRAL_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="💵 Вывести средства", callback_data="withdraw_earned")
+    ],
+    [
+        InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")
+    ]
+])
+
+# Инструкции по настройке для каждой ОС
+INSTRUCTIONS = {
+    "android": (
+        "Инструкция для Android:\n"
+        "1️⃣ Скопируйте ключ доступа;\n"
+        "2️⃣ Установите приложение 🌐V2rayNG;\n"
+        "3️⃣ Запустите программу V2rayNG и нажми ➕ в правом верхнем углу;\n"
+        "4️⃣ Выберите «Импорт из буфера обмена»;\n"
+        "5️⃣ Нажмите круглую кнопку включения и наслаждайтесь высокой скоростью и стабильностью."
+    ),
+    "ios": (
+        "Инструкция для IOS:\n"
+        "1️⃣ Скопируйте ключ доступа;\n"
+        "2️⃣ Установите приложение 🌐Streisand;\n"
+        "3️⃣ Запустите программу Streisand и нажмите ➕ в правом верхнем углу;\n"
+        "4️⃣ Выберите «Добавить из буфера» (если программа спросит разрешение на вставку - разрешите);\n"
+        "5️⃣ Нажмите круглую кнопку включения внизу и наслаждайтесь высокой скоростью и стабильностью.\n\n"
+        "Также ты можешь настроить автоматическое ВКЛ/ВЫКЛ VPN при входе в Instagram (всё также, только нужно выбирать Streisand вместо WireGuard)."
+    ),
+    "macos": (
+        "Инструкция для MacOS:\n"
+        "1️⃣ Скопируйте ключ доступа;\n"
+        "2️⃣ Скачайте и установите приложение 🌐V2Box;\n"
+        "3️⃣ Запустите программу V2Box и перейдите на вкладку «Configs» (снизу);\n"
+        "4️⃣ Далее нажмите ➕ в правом верхнем углу и выберите «Import v2ray uri from clipboard» (первый пункт в списке);\n"
+        "5️⃣ После перейдите на вкладку «Home» (снизу) и нажмите большую кнопку (снизу) «Tap to Connect»;\n"
+        "6️⃣ Наслаждайтесь высокой скоростью и стабильностью."
+    ),
+    "windows": (
+        "Инструкция для Windows:\n"
+        "1️⃣ Скопируйте ключ доступа;\n"
+        "2️⃣ Установите последний релиз для своей ОС с GitHub;\n"
+        "3️⃣ Для Windows рекомендуем версию Portable или Setup. Запускайте программу с правами администратора;\n"
+        "4️⃣ Выберите регион: для РФ - “Россия”, для остальных - “Другой”;\n"
+        "5️⃣ Копируйте подписку и нажмите “Новый профиль”, затем “Добавить профиль из буфера обмена”;\n"
+        "6️⃣ Наслаждайся высокой скоростью и стабильностью!"
+    ),
+    "tv": (
+        "Инструкция для TV:\n"
+        "1⃣ Установите приложение v2RayTun из GooglePlay;\n"
+        "2⃣ На телевизоре, в приложении v2RayTun на главном экране выберите Управление;\n"
+        "3⃣ Далее выберите Ручной ввод (если собираетесь руками вводить)/либо 'импорт из буфера обмена' если вы ее скопировали любым способом/либо 'Импорт из файла' (если копируете из блокнота)."
+    ),
+}
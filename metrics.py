@@ -0,0 +1,205 @@
+import bisect
+import functools
+import inspect
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунд
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    # Метрики хранятся в обычных словарях: на горячем пути — только поиск по ключу и сложение,
+    # текст в формате Prometheus собирается лишь при запросе /metrics
+    def __init__(self):
+        self.help = {}  # имя -> (тип, описание)
+        self.counters = {}  # (имя, метки) -> значение
+        self.gauges = {}
+        self.histograms = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_total(self, name, labels=(), value=0):
+        # Для счётчиков, которые ведутся в другом месте (например, в кэшах)
+        self.counters[(name, labels)] = value
+
+    def set(self, name, labels=(), value=0):
+        self.gauges[(name, labels)] = value
+
+    def add(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def render(self):
+        lines = []
+        for name, (kind, text) in sorted(self.help.items()):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+            else:
+                values = self.counters if kind == "counter" else self.gauges
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REGISTRY = Registry()
+REGISTRY.describe("bot_handler_seconds", "histogram", "Время обработки обновления по обработчикам")
+REGISTRY.describe("bot_handler_errors_total", "counter", "Исключения в обработчиках")
+REGISTRY.describe("bot_updates_in_flight", "gauge", "Обновления в обработке")
+REGISTRY.describe("db_call_seconds", "histogram", "Время вызова методов Database")
+REGISTRY.describe("db_call_errors_total", "counter", "Исключения в методах Database")
+REGISTRY.describe("http_client_seconds", "histogram", "Время исходящих HTTP-запросов к узлам и платёжному API")
+REGISTRY.describe("http_client_errors_total", "counter", "Исходящие HTTP-запросы с ответом 5xx")
+REGISTRY.describe("telegram_api_seconds", "histogram", "Время запросов к Bot API по методам")
+REGISTRY.describe("telegram_api_errors_total", "counter", "Неудачные запросы к Bot API")
+
+class HandlerMetrics(BaseMiddleware):
+    # Внутренний middleware: к этому моменту aiogram уже выбрал обработчик
+    def __init__(self, registry=REGISTRY, label=None):
+        self.registry = registry
+        self.label = label  # label(event, data) -> имя обработчика или None
+
+    async def __call__(self, handler, event, data):
+        name = self.label(event, data) if self.label else None
+        if name is None:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object else "unknown"
+        labels = (("handler", name),)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            self.registry.observe("bot_handler_seconds", labels, time.perf_counter() - started)
+
+class InFlightMetrics(BaseMiddleware):
+    # Внешний middleware на update: считает все обновления, включая те, что не дошли до обработчика
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        self.registry.add("bot_updates_in_flight")
+        try:
+            return await handler(event, data)
+        finally:
+            self.registry.add("bot_updates_in_flight", value=-1)
+
+class TelegramMetrics(BaseRequestMiddleware):
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", type(method).__name__),)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.registry.inc("telegram_api_errors_total", labels)
+            raise
+        finally:
+            self.registry.observe("telegram_api_seconds", labels, time.perf_counter() - started)
+
+def httpx_hooks(client_name, registry=REGISTRY):
+    # event_hooks для httpx.AsyncClient: время от отправки запроса до получения заголовков ответа
+    async def on_request(request):
+        request.extensions["metrics_started"] = time.perf_counter()
+
+    async def on_response(response):
+        started = response.request.extensions.get("metrics_started")
+        if started is None:
+            return
+        labels = (("client", client_name), ("host", response.request.url.host))
+        registry.observe("http_client_seconds", labels, time.perf_counter() - started)
+        if response.status_code >= 500:
+            registry.inc("http_client_errors_total", labels)
+
+    return {"request": [on_request], "response": [on_response]}
+
+def instrument(obj, skip=(), registry=REGISTRY):
+    # Оборачивает публичные async-методы экземпляра (например, Database) замером времени
+    cls = type(obj)
+    for name, function in inspect.getmembers(cls, inspect.iscoroutinefunction):
+        if name.startswith("_") or name in skip:
+            continue
+        setattr(obj, name, timed(getattr(obj, name), (("method", name),), registry))
+    return obj
+
+def timed(method, labels, registry):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            registry.inc("db_call_errors_total", labels)
+            raise
+        finally:
+            registry.observe("db_call_seconds", labels, time.perf_counter() - started)
+    return wrapper
+
+async def start_metrics_server(host, port, registry=REGISTRY, collectors=()):
+    # collectors — функции без аргументов, обновляющие значения перед выдачей (размеры очередей, кэшей)
+    async def handle(request):
+        for collect in collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.warning(f"Ошибка при сборе метрик: {e}")
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на {host}:{port}/metrics")
+    return runner
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import time
+
+from server_allocator import DEFAULT_CAPACITY
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 5000  # строк за одну транзакцию при заполнении новых колонок
+
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+async def add_column(connection, table, column, definition):
+    async with connection.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if column not in columns:
+        await connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+async def migrate(connection):
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at INTEGER
+    )
+    """)
+    await connection.commit()
+    async with connection.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cursor:
+        current = (await cursor.fetchone())[0]
+
+    for version, description, function in sorted(MIGRATIONS):
+        if version <= current:
+            continue
+        logger.info(f"Миграция {version}: {description}")
+        await function(connection)
+        await connection.execute(
+            "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, int(time.time()))
+        )
+        await connection.commit()
+
+@migration(1, "исходная схема")
+async def initial_schema(connection):
+    # Все операторы идемпотентны: базы, созданные до появления миграций, приводятся к той же схеме
+    # Таблица пользователей
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER UNIQUE,
+        balance REAL DEFAULT 0,
+        earned REAL DEFAULT 0,  -- Заработанные средства
+        referral_id INTEGER DEFAULT NULL
+    )
+    """)
+    # Таблица ключей
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS keys (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        key TEXT UNIQUE,
+        expires_at TEXT,
+        server_id INTEGER
+    )
+    """)
+    # Таблица серверов
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS servers (
+        id INTEGER PRIMARY KEY,
+        ip TEXT UNIQUE,
+        port INTEGER,
+        protocol TEXT,
+        status TEXT DEFAULT 'active'
+    )
+    """)
+    # Таблица цен
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS prices (
+        id INTEGER PRIMARY KEY,
+        tariff TEXT UNIQUE,
+        amount REAL
+    )
+    """)
+    # Таблица рассылок (прогресс сохраняется, чтобы продолжить после перезапуска)
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY,
+        text TEXT,
+        admin_id INTEGER,
+        total INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,  -- Последний обработанный user_id
+        sent INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running'
+    )
+    """)
+    # Таблица платежей, ожидающих подтверждения
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS pending_payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        tariff TEXT,
+        amount REAL,
+        days INTEGER,
+        status TEXT DEFAULT 'pending',  -- pending, completed, canceled, expired
+        attempts INTEGER DEFAULT 0,
+        next_check_at INTEGER,  -- Unix-время следующей проверки
+        created_at INTEGER,
+        key TEXT
+    )
+    """)
+    # Журнал движения средств: бонусы, выводы, пополнения
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        kind TEXT,  -- referral_bonus, withdrawal, top_up
+        balance_delta REAL DEFAULT 0,
+        earned_delta REAL DEFAULT 0,
+        ref TEXT,  -- Связанный платёж или пользователь
+        created_at INTEGER
+    )
+    """)
+    await add_column(connection, "servers", "capacity", f"INTEGER DEFAULT {DEFAULT_CAPACITY}")
+    await add_column(connection, "keys", "reminded", "INTEGER DEFAULT 0")
+    await add_column(connection, "keys", "paid", "INTEGER DEFAULT 0")
+    await add_column(connection, "users", "created_at", "TEXT")
+    await add_column(connection, "prices", "days", "INTEGER")
+    await add_column(connection, "prices", "title", "TEXT")
+    # Индексы
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON keys (user_id)")
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_server_id ON keys (server_id)")
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)")
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_id ON ledger (user_id)")
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_due ON pending_payments (status, next_check_at)")
+
+@migration(2, "keys.expires_ts: срок действия в Unix-времени")
+async def expires_ts(connection):
+    await add_column(connection, "keys", "expires_ts", "INTEGER")
+    await connection.commit()
+
+    # Заполняем пачками по диапазонам id: каждая транзакция короткая и не держит блокировку записи
+    async with connection.execute("SELECT COALESCE(MAX(id), 0) FROM keys") as cursor:
+        max_id = (await cursor.fetchone())[0]
+    for start in range(0, max_id, BACKFILL_BATCH):
+        # expires_at хранилось в локальном времени, модификатор 'utc' переводит его в UTC
+        await connection.execute(
+            "UPDATE keys SET expires_ts = CAST(strftime('%s', expires_at, 'utc') AS INTEGER) "
+            "WHERE id > ? AND id <= ? AND expires_ts IS NULL AND expires_at IS NOT NULL",
+            (start, start + BACKFILL_BATCH)
+        )
+        await connection.commit()
+        await asyncio.sleep(0)
+    # Текстовая колонка expires_at больше не используется и не заполняется для новых ключей
+    await connection.execute("DROP INDEX IF EXISTS idx_expires_at")
+
+@migration(3, "индексы для рефералов и сроков действия ключей")
+async def expiry_indexes(connection):
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_id ON users (referral_id)")
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_keys_expires_ts ON keys (expires_ts)")
+    # Частичный индекс по активным ключам, о которых ещё не напомнили:
+    # по нему планировщик напоминаний выбирает ближайшие сроки
+    await connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_keys_active ON keys (expires_ts) WHERE reminded = 0"
+    )
+
+@migration(4, "параметры подключения VLESS для серверов")
+async def server_connection_settings(connection):
+    # host — публичный адрес для клиентов (если пусто, используется ip), vless_port — порт входящего
+    # подключения; port остаётся портом API узла
+    await add_column(connection, "servers", "host", "TEXT")
+    await add_column(connection, "servers", "vless_port", "INTEGER DEFAULT 443")
+    await add_column(connection, "servers", "transport", "TEXT DEFAULT 'tcp'")  # tcp, ws, grpc, httpupgrade, xhttp
+    await add_column(connection, "servers", "security", "TEXT DEFAULT 'none'")  # none, tls, reality
+    await add_column(connection, "servers", "sni", "TEXT")
+    await add_column(connection, "servers", "flow", "TEXT")  # например, xtls-rprx-vision
+    await add_column(connection, "servers", "public_key", "TEXT")  # pbk для Reality
+    await add_column(connection, "servers", "short_id", "TEXT")  # sid для Reality
+    await add_column(connection, "servers", "fingerprint", "TEXT DEFAULT 'chrome'")
+    await add_column(connection, "servers", "path", "TEXT")  # путь ws/httpupgrade или serviceName gRPC
+    await add_column(connection, "servers", "label", "TEXT")  # название в клиенте после #
+
+@migration(5, "пул заранее зарегистрированных на узлах ключей")
+async def key_pool(connection):
+    await connection.execute("""
+    CREATE TABLE IF NOT EXISTS key_pool (
+        id INTEGER PRIMARY KEY,
+        server_id INTEGER,
+        key TEXT UNIQUE,
+        created_at INTEGER
+    )
+    """)
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_key_pool_server_id ON key_pool (server_id, id)")
+
+@migration(6, "токены подписки пользователей")
+async def subscription_tokens(connection):
+    await add_column(connection, "users", "sub_token", "TEXT")
+    await connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_sub_token ON users (sub_token)")
+
+@migration(7, "счётчики реферальной сети")
+async def referral_counters(connection):
+    # referrals_direct/revenue_direct — по приглашённым напрямую, referrals_total/revenue_total — по всем уровням.
+    # Выручка — сумма завершённых платежей
+    await add_column(connection, "users", "referrals_direct", "INTEGER DEFAULT 0")
+    await add_column(connection, "users", "referrals_total", "INTEGER DEFAULT 0")
+    await add_column(connection, "users", "revenue_direct", "REAL DEFAULT 0")
+    await add_column(connection, "users", "revenue_total", "REAL DEFAULT 0")
+    await connection.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_referrals_total ON users (referrals_total) WHERE referrals_total > 0"
+    )
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_pending_payments_user_id ON pending_payments (user_id)")
+    await connection.execute("CREATE TEMP TABLE paid AS SELECT user_id, SUM(amount) AS amount FROM pending_payments WHERE status = 'completed' GROUP BY user_id")
+    await connection.execute("CREATE INDEX temp.idx_paid ON paid (user_id)")
+    # Все пары (пользователь, вышестоящий реферер). UNION убирает повторы, поэтому цикл в старых данных
+    # не зацикливает запрос; сам пользователь в своей цепочке не учитывается
+    await connection.execute("""
+    CREATE TEMP TABLE chain AS
+    WITH RECURSIVE up(user_id, ancestor) AS (
+        SELECT user_id, referral_id FROM users WHERE referral_id IS NOT NULL
+        UNION
+        SELECT up.user_id, u.referral_id FROM up JOIN users u ON u.user_id = up.ancestor WHERE u.referral_id IS NOT NULL
+    )
+    SELECT up.ancestor, COUNT(*) AS referrals, COALESCE(SUM(paid.amount), 0) AS revenue
+    FROM up LEFT JOIN paid ON paid.user_id = up.user_id
+    WHERE up.ancestor != up.user_id
+    GROUP BY up.ancestor
+    """)
+    await connection.execute("CREATE INDEX temp.idx_chain ON chain (ancestor)")
+    await connection.execute("""
+    UPDATE users SET
+        referrals_direct = (SELECT COUNT(*) FROM users r WHERE r.referral_id = users.user_id),
+        revenue_direct = (SELECT COALESCE(SUM(paid.amount), 0) FROM users r JOIN paid ON paid.user_id = r.user_id WHERE r.referral_id = users.user_id),
+        referrals_total = COALESCE((SELECT referrals FROM chain WHERE ancestor = users.user_id), 0),
+        revenue_total = COALESCE((SELECT revenue FROM chain WHERE ancestor = users.user_id), 0)
+    WHERE user_id IN (SELECT ancestor FROM chain)
+    """)
+    await connection.execute("DROP TABLE temp.chain")
+    await connection.execute("DROP TABLE temp.paid")
@@ -1,14 +1,61 @@
+import os
+import uuid
+
 import httpx
 
+from metrics import httpx_hooks
+
+_client = None
+
+# Адрес платёжного API. Если не задан — используются заглушки для тестирования
+def api_url():
+    return os.getenv("PAYMENT_API_URL")
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(base_url=api_url(), timeout=httpx.Timeout(10), event_hooks=httpx_hooks("payments"))
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 async def create_payment(amount, description):
-    # Возвращаем заглушку вместо реальной оплаты
-    return {
-        "id": "test_payment_id",
-        "confirmation": {
-            "confirmation_url": "https://example.com/payment"  # Заглушка
+    if not api_url():
+        # Возвращаем заглушку вместо реальной оплаты
+        return {
+            "id": f"test_{uuid.uuid4().hex}",
+            "status": "pending",
+            "confirmation": {
+                "confirmation_url": "https://example.com/payment"  # Заглушка
+            }
         }
-    }
+    response = await get_client().post(
+        "/payments",
+        json={"amount": amount, "description": description},
+        headers={"Idempotence-Key": uuid.uuid4().hex}
+    )
+    response.raise_for_status()
+    return response.json()
 
 async def check_payment_status(payment_id):
-    # Возвращаем успешный статус для тестирования
-    return {"status": "succeeded"}
+    if not api_url():
+        # Возвращаем успешный статус для тестирования
+        return {"status": "succeeded"}
+    response = await get_client().get(f"/payments/{payment_id}")
+    response.raise_for_status()
+    return response.json()
+
+async def cancel_payment(payment_id):
+    # Отмена неоплаченного счёта: после неё оплатить его уже нельзя. Возвращает платёж с итоговым статусом
+    if not api_url():
+        return {"status": "canceled"}
+    response = await get_client().post(
+        f"/payments/{payment_id}/cancel",
+        headers={"Idempotence-Key": uuid.uuid4().hex}
+    )
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from payment_handler import cancel_payment, check_payment_status
+
+logger = logging.getLogger(__name__)
+
+class PaymentReconciler:
+    def __init__(self, db, on_paid, batch_size=200, concurrency=20, interval=5, ttl=3600, max_delay=300,
+                 cancel_timeout=24 * 3600):
+        self.db = db
+        self.on_paid = on_paid  # async (payment_id, user_id, tariff, amount, days) -> bool, True если платёж закрыт
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        self.ttl = ttl  # через сколько секунд неоплаченный счёт считается просроченным
+        self.max_delay = max_delay
+        self.cancel_timeout = cancel_timeout  # сколько после ttl пытаемся отменить счёт, прежде чем закрыть его у себя
+
+    def backoff(self, attempts):
+        # Экспоненциально реже проверяем платежи, которые долго остаются неоплаченными
+        delay = min(self.interval * 2 ** attempts, self.max_delay)
+        return int(time.time() + delay * random.uniform(0.8, 1.2))
+
+    async def run(self):
+        while True:
+            try:
+                processed = await self.reconcile_batch()
+            except Exception as e:
+                logger.error(f"Ошибка при сверке платежей: {e}")
+                processed = 0
+            # Полная пачка — значит, в очереди есть ещё платежи, продолжаем сразу
+            if processed < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def reconcile_batch(self):
+        now = int(time.time())
+        rows = await self.db.get_due_payments(now, self.batch_size)
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self.check(row, now) for row in rows))
+
+        retry, expired, canceled, failed = [], [], [], []
+        for row, outcome in zip(rows, results):
+            payment_id, attempts = row[0], row[5]
+            if outcome == "retry":
+                retry.append((self.backoff(attempts), payment_id))
+            elif outcome == "overdue":
+                retry.append((now + self.max_delay, payment_id))
+            elif outcome == "expired":
+                expired.append(payment_id)
+            elif outcome == "canceled":
+                canceled.append(payment_id)
+            elif outcome == "failed":
+                failed.append(payment_id)
+        if retry:
+            await self.db.reschedule_payments(retry)
+        if expired:
+            await self.db.close_payments(expired, "expired")
+        if canceled:
+            await self.db.close_payments(canceled, "canceled")
+        if failed:
+            await self.db.close_payments(failed, "failed")
+        return len(rows)
+
+    async def check(self, row, now):
+        payment_id, user_id, tariff, amount, days, attempts, created_at = row
+        try:
+            async with self.semaphore:
+                payment = await check_payment_status(payment_id)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить платёж {payment_id}: {e}")
+            return "retry"
+
+        status = payment.get("status")
+        if status != "succeeded" and status != "canceled" and now - created_at > self.ttl:
+            # Просроченный счёт сначала отменяем у платёжной системы, чтобы его нельзя было оплатить
+            # после закрытия. Не удалось — проверяем дальше с максимальной задержкой
+            try:
+                async with self.semaphore:
+                    payment = await cancel_payment(payment_id)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code >= 500:
+                    logger.warning(f"Не удалось отменить платёж {payment_id}: {e}")
+                    return self.overdue(payment_id, created_at, now)
+                # Отказ платёжной системы окончательный (счёт уже оплачен, отменён или ей неизвестен):
+                # повтор ничего не даст, смотрим итоговый статус
+                logger.warning(f"Платёж {payment_id} не отменён: {e}")
+                try:
+                    async with self.semaphore:
+                        payment = await check_payment_status(payment_id)
+                except Exception as e:
+                    logger.warning(f"Не удалось проверить платёж {payment_id}: {e}")
+                    return self.overdue(payment_id, created_at, now)
+                if payment.get("status") not in ("succeeded", "canceled"):
+                    return "failed"
+            except Exception as e:
+                logger.warning(f"Не удалось отменить платёж {payment_id}: {e}")
+                return self.overdue(payment_id, created_at, now)
+            status = payment.get("status")
+            if status == "canceled":
+                return "expired"
+            if status != "succeeded":
+                return self.overdue(payment_id, created_at, now)
+        if status == "succeeded":
+            try:
+                if await self.on_paid(payment_id, user_id, tariff, amount, days):
+                    return "done"
+            except Exception as e:
+                logger.error(f"Ошибка при выдаче ключа по платежу {payment_id}: {e}")
+            return "retry"
+        if status == "canceled":
+            return "canceled"
+        return "retry"
+
+    def overdue(self, payment_id, created_at, now):
+        # Счёт так и не удалось отменить: закрываем его у себя, чтобы очередь проверок не росла бесконечно
+        if now - created_at > self.ttl + self.cancel_timeout:
+            logger.error(f"Платёж {payment_id} не удалось отменить, закрыт как failed")
+            return "failed"
+        return "overdue"
@@ -0,0 +1,45 @@
+import time
+from collections import OrderedDict, namedtuple
+
+from versioned_cache import VersionedCache
+
+# Компактный профиль пользователя для частых экранов
+Profile = namedtuple("Profile", "balance earned referral_id referrals keys referrals_total revenue_direct revenue_total")
+
+MISSING = object()
+
+class ProfileCache(VersionedCache):
+    def __init__(self, max_size=10000, ttl=300):
+        super().__init__(max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (время записи, профиль или None)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, profile, version):
+        # Если пока шёл запрос к базе профиль успел измениться, результат уже устарел
+        if version != self.version(user_id):
+            return
+        self.entries[user_id] = (time.monotonic(), profile)
+        self.entries.move_to_end(user_id)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self.bump(user_id)
+            self.entries.pop(user_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
@@ -1,17 +1,61 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
 def generate_referral_link(bot_username, user_id):
     return f"https://t.me/{bot_username}?start={user_id}"
 
-def get_referral_info(db, user_id):
+async def get_referral_info(db, user_id):
     try:
-        referrals = db.get_referrals(user_id)
-        balance = db.get_balance(user_id)
-        earned = db.get_earned(user_id)
+        profile = await db.get_profile(user_id)
+        if profile is None:
+            return "Вы ещё не зарегистрированы. Отправьте /start."
         return (
-            f"👥 Ваши рефералы: {len(referrals)}\n"
-            f"💰 Ваш баланс: {balance} руб.\n"
-            f"💵 Заработано: {earned} руб.\n\n"
+            f"👥 Ваши рефералы: {profile.referrals} (всего в сети: {profile.referrals_total})\n"
+            f"💰 Ваш баланс: {profile.balance} руб.\n"
+            f"💵 Заработано: {profile.earned} руб.\n\n"
             f"💡 Приглашайте друзей и получайте бонусы!"
         )
     except Exception as e:
         logger.error(f"Ошибка в get_referral_info: {e}")
         return "Произошла ошибка при получении информации."
+
+class ReferralLeaderboard:
+    # Топ рефереров для админа: счётчики уже посчитаны в users, запрос читает только верх частичного индекса
+    def __init__(self, db, size=10, ttl=300):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.rows = None
+        self.updated = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self):
+        if self.rows is not None and time.monotonic() - self.updated < self.ttl:
+            return self.rows
+        async with self.lock:
+            if self.rows is None or time.monotonic() - self.updated >= self.ttl:
+                self.rows = await self.db.get_referral_leaders(self.size)
+                self.updated = time.monotonic()
+        return self.rows
+
+def format_leaderboard(rows):
+    if not rows:
+        return "Пока никто никого не пригласил."
+    lines = ["🏆 Топ рефереров:\n"]
+    for place, (user_id, direct, total, revenue_direct, revenue_total) in enumerate(rows, 1):
+        lines.append(
+            f"{place}. {user_id}: приглашено {direct}, в сети {total}, "
+            f"оплаты {revenue_direct:g} руб. (по сети {revenue_total:g} руб.)"
+        )
+    return "\n".join(lines)
+
+def format_downline(user_id, levels):
+    if not levels:
+        return f"У пользователя {user_id} нет рефералов."
+    lines = [f"🌳 Реферальная сеть пользователя {user_id}:\n"]
+    for depth, count, revenue in levels:
+        lines.append(f"Уровень {depth}: {count} польз., оплаты {revenue:g} руб.")
+    return "\n".join(lines)
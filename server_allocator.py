@@ -0,0 +1,115 @@
+import heapq
+import math
+import time
+
+DEFAULT_CAPACITY = 1000
+
+# Ключи истекают «пачками» по минутам: хранить отдельную запись на каждый ключ не нужно
+def expiry_bucket(expires_ts):
+    return expires_ts // 60
+
+def current_bucket():
+    return int(time.time()) // 60
+
+class ServerAllocator:
+    def __init__(self):
+        self.capacity = {}  # server_id -> допустимое число живых ключей (только активные серверы)
+        self.load = {}  # server_id -> число живых (неистёкших) ключей
+        self.penalty = {}  # server_id -> надбавка за задержку и ошибки узла (см. HealthMonitor)
+        self.version = {}  # server_id -> версия актуальной записи в куче, не сбрасывается при удалении сервера
+        self.heap = []  # (приоритет, server_id, версия), устаревшие записи удаляются лениво
+        self.expiry_heap = []  # минуты (Unix-время // 60), в которые истекают ключи
+        self.expiry_buckets = {}  # минута -> {server_id: число ключей}
+
+    def set_server(self, server_id, capacity):
+        self.capacity[server_id] = capacity if capacity and capacity > 0 else DEFAULT_CAPACITY
+        self._push(server_id)
+
+    def remove_server(self, server_id):
+        # Версия только растёт: иначе после повторного добавления старые записи кучи снова стали бы актуальными
+        self.capacity.pop(server_id, None)
+        if server_id in self.version:
+            self.version[server_id] += 1
+
+    def set_penalty(self, server_id, penalty):
+        self.penalty[server_id] = penalty
+        if server_id in self.capacity:
+            self._push(server_id)
+
+    def add_key(self, server_id, expires_ts, count=1):
+        bucket = expiry_bucket(expires_ts)
+        if bucket <= current_bucket():
+            return
+        servers = self.expiry_buckets.get(bucket)
+        if servers is None:
+            servers = self.expiry_buckets[bucket] = {}
+            heapq.heappush(self.expiry_heap, bucket)
+        servers[server_id] = servers.get(server_id, 0) + count
+        self._change_load(server_id, count)
+
+    def remove_key(self, server_id, expires_ts):
+        servers = self.expiry_buckets.get(expiry_bucket(expires_ts))
+        if not servers or not servers.get(server_id):
+            return  # ключ уже истёк и не учитывается в загрузке
+        servers[server_id] -= 1
+        self._change_load(server_id, -1)
+
+    def pick(self):
+        self._expire()
+        while self.heap:
+            priority, server_id, version = self.heap[0]
+            if server_id not in self.capacity or self.version.get(server_id) != version:
+                heapq.heappop(self.heap)
+                continue
+            # Заполненные серверы стоят в конце кучи: если лучший заполнен — заполнены все
+            return server_id if priority != math.inf else None
+        return None
+
+    def plan(self, count):
+        # Распределение пачки ключей без изменения состояния: каждый следующий ключ — на сервер,
+        # который с учётом уже распределённых окажется наименее загружен. Загрузка меняется
+        # только после записи ключей в базу (add_key). Если места не хватило, список короче count
+        self._expire()
+        load = {server_id: self.load.get(server_id, 0) for server_id in self.capacity}
+        heap = []
+        for server_id, capacity in self.capacity.items():
+            if load[server_id] < capacity:
+                heap.append((load[server_id] / capacity + self.penalty.get(server_id, 0), server_id))
+        heapq.heapify(heap)
+        servers = []
+        while heap and len(servers) < count:
+            _, server_id = heap[0]
+            servers.append(server_id)
+            load[server_id] += 1
+            capacity = self.capacity[server_id]
+            if load[server_id] < capacity:
+                heapq.heapreplace(heap, (load[server_id] / capacity + self.penalty.get(server_id, 0), server_id))
+            else:
+                heapq.heappop(heap)
+        return servers
+
+    def _change_load(self, server_id, delta):
+        self.load[server_id] = self.load.get(server_id, 0) + delta
+        if server_id in self.capacity:
+            self._push(server_id)
+
+    def _push(self, server_id):
+        version = self.version.get(server_id, 0) + 1
+        self.version[server_id] = version
+        ratio = self.load.get(server_id, 0) / self.capacity[server_id]
+        priority = ratio + self.penalty.get(server_id, 0) if ratio < 1 else math.inf
+        heapq.heappush(self.heap, (priority, server_id, version))
+        if len(self.heap) > 4 * len(self.version) + 64:
+            self._compact()
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if entry[1] in self.capacity and self.version.get(entry[1]) == entry[2]]
+        heapq.heapify(self.heap)
+
+    def _expire(self):
+        now = current_bucket()
+        while self.expiry_heap and self.expiry_heap[0] <= now:
+            bucket = heapq.heappop(self.expiry_heap)
+            for server_id, count in self.expiry_buckets.pop(bucket).items():
+                if count:
+                    self._change_load(server_id, -count)
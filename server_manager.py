@@ -1,20 +1,99 @@
-import httpx
+import asyncio
+import random
 import logging
 
+import httpx
+
+from metrics import httpx_hooks
+
 logger = logging.getLogger(__name__)
 
-async def configure_server(ip, port, username, password, key):
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"http://{ip}:{port}/add-user",
-                json={"key": key}
-            )
-            if response.status_code == 200:
-                return True
-            else:
-                logger.error(f"Ошибка при выполнении команды на сервере: {response.text}")
-                return False
-    except Exception as e:
-        logger.error(f"Ошибка при настройке сервера: {e}")
+class NodeClient:
+    def __init__(self, per_node=4, timeout=10, retries=3, batch_window=0.05, max_batch=100):
+        # Один долгоживущий клиент: httpx держит отдельный пул keep-alive соединений на каждый узел
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=per_node * 16, keepalive_expiry=60),
+            event_hooks=httpx_hooks("node")
+        )
+        self.per_node = per_node
+        self.retries = retries
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.semaphores = {}  # (ip, port) -> ограничение одновременных запросов к узлу
+        self.pending = {}  # (ip, port) -> [(key, future)] ключи, ждущие отправки пачкой
+        self.timers = {}  # (ip, port) -> отложенная отправка текущей пачки
+
+    async def close(self):
+        await self.client.aclose()
+
+    def semaphore(self, node):
+        semaphore = self.semaphores.get(node)
+        if semaphore is None:
+            semaphore = self.semaphores[node] = asyncio.Semaphore(self.per_node)
+        return semaphore
+
+    async def post(self, ip, port, path, payload):
+        node = (ip, port)
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore(node):
+                    response = await self.client.post(f"http://{ip}:{port}{path}", json=payload)
+                if response.status_code == 200:
+                    return True
+                if response.status_code < 500:
+                    logger.error(f"Ошибка при выполнении команды на сервере {ip}: {response.text}")
+                    return False
+                logger.warning(f"Сервер {ip} вернул {response.status_code}, попытка {attempt + 1}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Сервер {ip} недоступен ({e!r}), попытка {attempt + 1}")
+            if attempt < self.retries:
+                # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли волной
+                await asyncio.sleep(0.2 * 2 ** attempt * random.uniform(0.5, 1.5))
+        logger.error(f"Ошибка при настройке сервера {ip}: попытки исчерпаны")
         return False
+
+    async def add_users(self, ip, port, keys):
+        if len(keys) == 1:
+            return await self.post(ip, port, "/add-user", {"key": keys[0]})
+        return await self.post(ip, port, "/add-user", {"keys": keys})
+
+    async def add_user(self, ip, port, key):
+        # Ключи, выданные в течение batch_window, уходят на узел одним запросом
+        node = (ip, port)
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.get(node)
+        if batch is None:
+            batch = self.pending[node] = []
+            self.timers[node] = asyncio.get_running_loop().call_later(self.batch_window, self.flush, node)
+        batch.append((key, future))
+        if len(batch) >= self.max_batch:
+            self.flush(node)
+        return await future
+
+    def flush(self, node):
+        # Пачка ушла раньше срока (набралось max_batch) — её таймер не должен отправить следующую досрочно
+        timer = self.timers.pop(node, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(node, None)
+        if batch:
+            asyncio.create_task(self.send_batch(node, batch))
+
+    async def send_batch(self, node, batch):
+        try:
+            result = await self.add_users(node[0], node[1], [key for key, _ in batch])
+        except Exception as e:
+            logger.error(f"Ошибка при отправке ключей на сервер {node[0]}: {e}")
+            result = False
+        for _, future in batch:
+            if not future.done():
+                future.set_result(result)
+
+_default_client = None
+
+async def configure_server(ip, port, username, password, key):
+    global _default_client
+    if _default_client is None:
+        _default_client = NodeClient()
+    return await _default_client.add_user(ip, port, key)
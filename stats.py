@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+SIGNUP_DAYS = 7  # за сколько последних дней показывать регистрации
+
+class StatsCache:
+    def __init__(self, db, ttl=60):
+        self.db = db
+        self.ttl = ttl
+        self.snapshot = None
+        self.updated = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self):
+        if self.snapshot is not None and time.monotonic() - self.updated < self.ttl:
+            return self.snapshot
+        # Пока один запрос пересчитывает статистику, остальные ждут его результат
+        async with self.lock:
+            if self.snapshot is None or time.monotonic() - self.updated >= self.ttl:
+                since = (datetime.now() - timedelta(days=SIGNUP_DAYS - 1)).strftime("%Y-%m-%d")
+                stats = await self.db.get_stats(since)
+                if stats is not None:
+                    stats["keys_per_server"] = dict(self.db.allocator.load)
+                    stats["profile_hits"] = self.db.profiles.hits
+                    stats["profile_misses"] = self.db.profiles.misses
+                    stats["generated_at"] = datetime.now().strftime("%H:%M:%S")
+                    self.snapshot = stats
+                    self.updated = time.monotonic()
+        return self.snapshot
+
+def format_stats(stats):
+    servers = "\n".join(
+        f"  • сервер {server_id}: {count}" for server_id, count in sorted(stats["keys_per_server"].items())
+    ) or "  нет данных"
+    signups = "\n".join(f"  • {day}: {count}" for day, count in stats["signups"]) or "  нет регистраций"
+    return (
+        f"📊 Статистика (на {stats['generated_at']}):\n\n"
+        f"👥 Пользователей: {stats['users']}\n"
+        f"🔑 Ключей: {stats['active_keys'] + stats['expired_keys']} "
+        f"(активных {stats['active_keys']}, истёкших {stats['expired_keys']})\n"
+        f"💳 Платных: {stats['paid_keys']}, 🆓 пробных: {stats['trial_keys']}\n"
+        f"💵 Реферальные начисления: {stats['bonus_total']:g} руб. "
+        f"(выведено на баланс {stats['withdrawn_total']:g}, не выведено {stats['earned_total']:g})\n\n"
+        f"🗂 Кэш профилей: попаданий {stats['profile_hits']}, промахов {stats['profile_misses']}\n\n"
+        f"🖥 Активные ключи по серверам:\n{servers}\n\n"
+        f"📈 Регистрации за {SIGNUP_DAYS} дн.:\n{signups}"
+    )
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Локальные заглушки внешних сервисов для ручной проверки и нагрузочных тестов.
+# Запуск: python stubs.py node --port 8081 --delay 0.05 --fail-rate 0.1
+#         python stubs.py payments --port 8082 --pay-after 10 --success-rate 0.9
+#         python stubs.py replay updates.jsonl --url http://127.0.0.1:8080/webhook --secret ...
+
+def create_node_app(delay=0.0, fail_rate=0.0):
+    app = web.Application()
+    app["keys"] = set()
+    app["requests"] = 0
+
+    async def add_user(request):
+        app["requests"] += 1
+        await asyncio.sleep(delay)
+        if random.random() < fail_rate:
+            return web.Response(status=503, text="node overloaded")
+        payload = await request.json()
+        keys = payload.get("keys") or [payload.get("key")]
+        app["keys"].update(keys)
+        return web.json_response({"added": len(keys)})
+
+    async def health(request):
+        await asyncio.sleep(delay)
+        if random.random() < fail_rate:
+            return web.Response(status=503, text="unhealthy")
+        return web.json_response({"status": "ok", "keys": len(app["keys"])})
+
+    app.router.add_post("/add-user", add_user)
+    app.router.add_get("/health", health)
+    return app
+
+def create_payments_app(pay_after=5.0, success_rate=1.0, delay=0.0):
+    # Платёж «оплачивается» через случайное время до pay_after секунд после создания
+    # (или после первой проверки, если платёж создан в обход API, например при нагрузочном тесте)
+    app = web.Application()
+    app["payments"] = {}
+    app["requests"] = 0
+
+    def payment(payment_id):
+        if payment_id not in app["payments"]:
+            paid_at = time.monotonic() + random.uniform(0, pay_after)
+            status = "succeeded" if random.random() < success_rate else "canceled"
+            app["payments"][payment_id] = (paid_at, status)
+        return app["payments"][payment_id]
+
+    async def create(request):
+        app["requests"] += 1
+        await asyncio.sleep(delay)
+        payment_id = f"stub_{len(app['payments']) + 1}_{random.getrandbits(32):08x}"
+        payment(payment_id)
+        return web.json_response({
+            "id": payment_id,
+            "status": "pending",
+            "confirmation": {"confirmation_url": f"http://{request.host}/pay/{payment_id}"},
+        })
+
+    async def status(request):
+        app["requests"] += 1
+        await asyncio.sleep(delay)
+        paid_at, final_status = payment(request.match_info["payment_id"])
+        current = final_status if time.monotonic() >= paid_at else "pending"
+        return web.json_response({"id": request.match_info["payment_id"], "status": current})
+
+    async def cancel(request):
+        # Отменить можно только ещё не оплаченный счёт, иначе — 400, как у настоящей платёжной системы
+        app["requests"] += 1
+        await asyncio.sleep(delay)
+        payment_id = request.match_info["payment_id"]
+        paid_at, final_status = payment(payment_id)
+        if time.monotonic() >= paid_at and final_status == "succeeded":
+            return web.json_response({"id": payment_id, "status": final_status}, status=400)
+        app["payments"][payment_id] = (paid_at, "canceled")
+        return web.json_response({"id": payment_id, "status": "canceled"})
+
+    app.router.add_post("/payments", create)
+    app.router.add_post("/payments/{payment_id}/cancel", cancel)
+    app.router.add_get("/payments/{payment_id}", status)
+    return app
+
+def synthetic_updates(count, first_update_id=1, first_user_id=10 ** 9):
+    for i in range(count):
+        user_id = first_user_id + i
+        yield {
+            "update_id": first_update_id + i,
+            "message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{i}"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+
+def recorded_updates(path):
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+async def replay(updates, url, secret, concurrency):
+    # Имитация Telegram: отправляет обновления на вебхук так же, как это делают серверы Telegram
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret or ""}
+    statuses = {}
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def sender(session):
+        while True:
+            update = await queue.get()
+            if update is None:
+                return
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        senders = [asyncio.create_task(sender(session)) for _ in range(concurrency)]
+        for update in updates:
+            await queue.put(update)
+        for _ in senders:
+            await queue.put(None)
+        await asyncio.gather(*senders)
+    elapsed = time.monotonic() - started
+    total = sum(statuses.values())
+    print(f"Отправлено {total} обновлений за {elapsed:.2f} сек. ({total / elapsed:.0f}/сек.), ответы: {statuses}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушки внешних сервисов")
+    subparsers = parser.add_subparsers(dest="service", required=True)
+
+    node = subparsers.add_parser("node", help="узел VPN с /add-user и /health")
+    node.add_argument("--host", default="127.0.0.1")
+    node.add_argument("--port", type=int, default=8081)
+    node.add_argument("--delay", type=float, default=0.0, help="задержка ответа, секунд")
+    node.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 503")
+
+    payments = subparsers.add_parser("payments", help="платёжное API с /payments")
+    payments.add_argument("--host", default="127.0.0.1")
+    payments.add_argument("--port", type=int, default=8082)
+    payments.add_argument("--pay-after", type=float, default=5.0, help="максимальное время до оплаты, секунд")
+    payments.add_argument("--success-rate", type=float, default=1.0, help="доля успешных платежей")
+    payments.add_argument("--delay", type=float, default=0.0, help="задержка ответа, секунд")
+
+    player = subparsers.add_parser("replay", help="отправка записанных обновлений на вебхук бота")
+    player.add_argument("file", nargs="?", help="JSONL с обновлениями Telegram")
+    player.add_argument("--synthetic", type=int, default=0, help="вместо файла сгенерировать N команд /start")
+    player.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    player.add_argument("--secret", default="")
+    player.add_argument("--concurrency", type=int, default=20)
+
+    args = parser.parse_args()
+    if args.service == "node":
+        web.run_app(create_node_app(args.delay, args.fail_rate), host=args.host, port=args.port)
+    elif args.service == "payments":
+        app = create_payments_app(args.pay_after, args.success_rate, args.delay)
+        web.run_app(app, host=args.host, port=args.port)
+    elif args.service == "replay":
+        updates = synthetic_updates(args.synthetic) if args.synthetic else recorded_updates(args.file)
+        asyncio.run(replay(updates, args.url, args.secret, args.concurrency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from versioned_cache import VersionedCache
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = 12  # через сколько часов клиенту стоит обновить подписку
+
+class Subscription:
+    def __init__(self, user_id, body, etag, valid_until, generation, expire):
+        self.user_id = user_id
+        self.body = body
+        self.etag = etag
+        self.valid_until = valid_until  # ближайшее истечение ключа: после него ответ пересобирается
+        self.generation = generation  # Database.template_generation на момент сборки
+        self.expire = expire  # самое позднее истечение, для заголовка subscription-userinfo
+
+class SubscriptionCache(VersionedCache):
+    # Клиенты опрашивают подписку по таймеру: готовые ответы держим в памяти и сбрасываем
+    # только при изменении ключей пользователя, их истечении или изменении серверов
+    def __init__(self, db, unknown_size=10000, unknown_ttl=60, max_versions=100000):
+        super().__init__(max_versions)
+        self.db = db
+        self.entries = {}  # token -> Subscription
+        self.tokens = {}  # user_id -> token
+        self.building = {}  # token -> задача сборки, чтобы одновременные запросы не собирали ответ дважды
+        self.unknown = OrderedDict()  # token -> время, до которого токен считается несуществующим
+        self.unknown_size = unknown_size
+        self.unknown_ttl = unknown_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key_added(self, key_id, user_id, key, expires_ts, server_id):
+        self.invalidate(user_id)
+
+    def keys_removed(self, user_id, key_ids):
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id):
+        self.bump(user_id)
+        token = self.tokens.pop(user_id, None)
+        if token is not None:
+            self.entries.pop(token, None)
+
+    async def get(self, token):
+        entry = self.entries.get(token)
+        if entry is not None and time.time() < entry.valid_until and entry.generation == self.db.template_generation:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if self.unknown.get(token, 0) > time.monotonic():
+            return None
+        task = self.building.get(token)
+        if task is None:
+            task = self.building[token] = asyncio.create_task(self.build(token))
+            task.add_done_callback(lambda _: self.building.pop(token, None))
+        return await asyncio.shield(task)
+
+    async def build(self, token):
+        user_id = await self.db.get_user_by_sub_token(token)
+        if user_id is None:
+            self.unknown[token] = time.monotonic() + self.unknown_ttl
+            self.unknown.move_to_end(token)
+            while len(self.unknown) > self.unknown_size:
+                self.unknown.popitem(last=False)
+            return None
+        version = self.version(user_id)
+        generation = self.db.template_generation
+        now = int(time.time())
+        keys = await self.db.get_active_keys(user_id, now)
+        uris = await self.db.build_uris(keys)
+        body = base64.b64encode("\n".join(uris).encode()).decode()
+        etag = f'"{hashlib.sha1(body.encode()).hexdigest()[:20]}"'
+        valid_until = min((row[2] for row in keys), default=math.inf)
+        expire = max((row[2] for row in keys), default=0)
+        entry = Subscription(user_id, body, etag, valid_until, generation, expire)
+        if version == self.version(user_id):
+            self.entries[token] = entry
+            self.tokens[user_id] = token
+        return entry
+
+    async def handle(self, request):
+        entry = await self.get(request.match_info["token"])
+        if entry is None:
+            return web.Response(status=404)
+        headers = {
+            "ETag": entry.etag,
+            "Cache-Control": "no-cache",
+            "Profile-Update-Interval": str(UPDATE_INTERVAL),
+            "Subscription-Userinfo": f"upload=0; download=0; total=0; expire={entry.expire}",
+        }
+        if entry.etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=entry.body, content_type="text/plain", headers=headers)
+
+async def start_subscription_server(cache, host, port):
+    app = web.Application()
+    app.router.add_get("/sub/{token}", cache.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Сервер подписок запущен на {host}:{port}")
+    return runner
@@ -0,0 +1,62 @@
+import logging
+import math
+from collections import namedtuple
+from types import MappingProxyType
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from admin_panel import get_prices_menu
+from callback_router import callback_data
+
+logger = logging.getLogger(__name__)
+
+Tariff = namedtuple("Tariff", "tariff amount days title callback")
+
+# Тарифы по умолчанию: добавляются в таблицу prices, если их там ещё нет
+DEFAULT_TARIFFS = (
+    ("1_month", 300, 30, "1 месяц"),
+    ("3_months", 800, 90, "3 месяца"),
+    ("6_months", 1500, 180, "6 месяцев"),
+)
+
+def build_payment_menu(tariffs):
+    buttons = [
+        InlineKeyboardButton(text=f"{tariff.title} - {tariff.amount:g} руб", callback_data=tariff.callback)
+        for tariff in tariffs
+    ]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+class CatalogSnapshot:
+    def __init__(self, tariffs):
+        self.tariffs = tuple(tariffs)
+        self.by_name = MappingProxyType({tariff.tariff: tariff for tariff in self.tariffs})
+        self.payment_menu = build_payment_menu(self.tariffs)
+        self.prices_menu = get_prices_menu(self.tariffs)
+
+class TariffCatalog:
+    def __init__(self, db):
+        self.db = db
+        self.snapshot = CatalogSnapshot(())
+
+    async def load(self):
+        await self.db.seed_tariffs(DEFAULT_TARIFFS)
+        rows = await self.db.get_tariffs()
+        # Новый снимок подменяется одним присваиванием: обработчики видят либо старый, либо новый каталог
+        self.snapshot = CatalogSnapshot(
+            Tariff(tariff, amount, days, title, callback_data("buy", tariff)) for tariff, amount, days, title in rows
+        )
+        logger.info(f"Загружено тарифов: {len(self.snapshot.tariffs)}")
+
+    def get(self, tariff):
+        return self.snapshot.by_name.get(tariff)
+
+    async def edit_price(self, tariff, amount):
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError(f"недопустимая цена: {amount}")
+        if tariff not in self.snapshot.by_name:
+            return False
+        await self.db.update_price(tariff, amount)
+        await self.load()
+        return True
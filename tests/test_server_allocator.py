@@ -0,0 +1,28 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server_allocator import ServerAllocator
+
+def test_readded_server_is_not_picked_when_full():
+    # Сервер пропал (узел упал) и вернулся: записи кучи до удаления не должны снова считаться актуальными
+    allocator = ServerAllocator()
+    expires = int(time.time()) + 3600
+    allocator.set_server(1, 2)
+    allocator.add_key(1, expires)
+    allocator.remove_key(1, expires)
+    allocator.remove_server(1)
+    allocator.set_server(1, 2)
+    allocator.add_key(1, expires)
+    allocator.add_key(1, expires)
+    assert allocator.pick() is None
+    assert allocator.plan(1) == []
+
+def test_removed_server_is_not_picked():
+    allocator = ServerAllocator()
+    allocator.set_server(1, 2)
+    allocator.set_server(2, 2)
+    allocator.remove_server(1)
+    assert allocator.pick() == 2
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+logger = logging.getLogger(__name__)
+
+class Throttling(BaseMiddleware):
+    # Внешний middleware для сообщений и нажатий кнопок. У каждого пользователя — корзина токенов:
+    # rate нажатий в секунду в среднем и до burst подряд. Лишние обновления отбрасываются до фильтров
+    # и обработчиков, т.е. без обращений к базе. Сверх этого не более max_concurrent обновлений
+    # обрабатываются одновременно; если ещё max_waiting уже ждут очереди, новые тоже отбрасываются.
+    def __init__(self, rate=1.0, burst=5, max_concurrent=50, max_waiting=200, max_users=100000, exempt=()):
+        self.rate = rate
+        self.burst = burst
+        # Через столько секунд простоя корзина снова полная и неотличима от новой — запись можно удалить
+        self.idle = burst / rate
+        self.max_users = max_users
+        self.exempt = set(exempt)
+        self.buckets = OrderedDict()  # user_id -> [токены, время обновления]; в начале — давно неактивные
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.dropped = {"user": 0, "overload": 0}
+
+    def allow(self, user_id, now):
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(user_id)
+        self.evict(now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def evict(self, now):
+        # Записи упорядочены по последнему обращению, поэтому проверяем только начало
+        while self.buckets:
+            user_id, (_, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.idle and len(self.buckets) <= self.max_users:
+                break
+            del self.buckets[user_id]
+
+    async def reject(self, event, reason, text):
+        self.dropped[reason] += 1
+        # Нажатие кнопки нужно подтвердить, иначе клиент показывает часики; на сообщения не отвечаем
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer(text)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить на отброшенное нажатие: {e}")
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id not in self.exempt and not self.allow(user.id, time.monotonic()):
+            return await self.reject(event, "user", "⏳ Слишком часто. Подождите немного.")
+        if self.semaphore.locked() and self.waiting >= self.max_waiting:
+            return await self.reject(event, "overload", "⏳ Бот перегружен. Попробуйте через минуту.")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.semaphore.release()
@@ -0,0 +1,18 @@
+class VersionedCache:
+    # Версии пользователей растут при каждом сбросе: значение, прочитанное из базы до изменения,
+    # в кэш не попадает. Версия своя у каждого пользователя, чтобы изменения одного не мешали
+    # кэшировать остальных. Сброс запоминается так: перед чтением берём version(user_id),
+    # после чтения кладём в кэш, только если она не изменилась
+    def __init__(self, max_versions):
+        self.versions = {}  # user_id -> версия
+        self.epoch = 0  # растёт, когда versions очищается, чтобы словарь не рос без ограничений
+        self.max_versions = max_versions
+
+    def version(self, user_id):
+        return self.epoch, self.versions.get(user_id, 0)
+
+    def bump(self, user_id):
+        if len(self.versions) > self.max_versions:
+            self.versions.clear()
+            self.epoch += 1
+        self.versions[user_id] = self.versions.get(user_id, 0) + 1
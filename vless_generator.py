@@ -1,8 +1,48 @@
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
+from urllib.parse import quote, urlencode
 
 def generate_key():
     return str(uuid.uuid4())
 
-def get_expiration_date(days=1):
-    return (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+def get_expiration_ts(days=1):
+    # Срок действия хранится в Unix-времени: сравнение и арифметика без разбора строк
+    return int(time.time()) + days * 86400
+
+def format_expiration(expires_ts):
+    return datetime.fromtimestamp(expires_ts).strftime("%Y-%m-%d %H:%M:%S")
+
+# Колонки servers, из которых собирается ссылка (порядок совпадает с аргументами ServerTemplate)
+TEMPLATE_COLUMNS = (
+    "id, ip, port, COALESCE(host, ip), vless_port, transport, security, "
+    "sni, flow, public_key, short_id, fingerprint, path, label"
+)
+
+class ServerTemplate:
+    # Всё, что не зависит от ключа, собирается один раз: ссылка — это prefix + uuid + suffix
+    def __init__(self, server_id, ip, port, host, vless_port, transport, security,
+                 sni, flow, public_key, short_id, fingerprint, path, label):
+        self.server_id = server_id
+        self.ip = ip
+        self.port = port  # порт API узла для регистрации ключей
+        params = {"encryption": "none", "type": transport or "tcp", "security": security or "none"}
+        if security in ("tls", "reality"):
+            params["sni"] = sni or host
+            params["fp"] = fingerprint or "chrome"
+        if security == "reality":
+            params["pbk"] = public_key or ""
+            params["sid"] = short_id or ""
+        if flow:
+            params["flow"] = flow
+        if transport in ("ws", "httpupgrade", "xhttp"):
+            params["path"] = path or "/"
+            params["host"] = sni or host
+        elif transport == "grpc" and path:
+            params["serviceName"] = path
+        address = f"[{host}]" if ":" in host else host
+        self.prefix = "vless://"
+        self.suffix = f"@{address}:{vless_port or 443}?{urlencode(params, quote_via=quote)}#{quote(label or host, safe='')}"
+
+    def uri(self, key):
+        return f"{self.prefix}{key}{self.suffix}"
@@ -0,0 +1,80 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class WebhookHandler:
+    def __init__(self, dp, bot, secret, max_inflight=100):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        # Ограничение одновременно обрабатываемых обновлений: при переполнении
+        # ответ задерживается, и Telegram сам притормаживает доставку
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.tasks = set()
+        self.accepting = True
+
+    async def handle(self, request):
+        # Сравниваем байты: compare_digest не принимает строки с символами вне ASCII
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, "").encode(), self.secret.encode()):
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def process(self, update):
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {e}")
+        finally:
+            self.semaphore.release()
+
+    async def drain(self, timeout=30):
+        # Новые обновления больше не принимаем, ждём завершения уже начатых
+        self.accepting = False
+        if self.tasks:
+            logger.info(f"Ожидание завершения {len(self.tasks)} обновлений")
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            if pending:
+                logger.warning(f"Не дождались завершения {len(pending)} обновлений")
+
+async def run_webhook(dp, bot, url, path, secret, host, port, max_inflight=100):
+    # Без заданного секрета генерируем случайный: он передаётся Telegram при каждом запуске
+    secret = secret or secrets.token_urlsafe(32)
+    handler = WebhookHandler(dp, bot, secret, max_inflight)
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    await bot.set_webhook(f"{url}{path}", secret_token=secret, max_connections=min(max_inflight, 100))
+    logger.info(f"Вебхук запущен на {host}:{port}{path}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Остановка вебхука")
+        await handler.drain()
+        await runner.cleanup()